@@ -1,18 +1,20 @@
 """Dash application"""
+from covid19.profiling import profiler  # first, so that the imports below are profiled
 from logging import getLogger
-from typing import List, Tuple
+from typing import Any, Callable, List, Optional, Tuple
 
 import dash
-import dash_core_components as dcc
-import dash_html_components as html
-import plotly.graph_objects as go
+from dash import dcc, html
 from decouple import config
-from flask import Flask
-
-from covid19 import callbacks as cb, plots as p
-from covid19.data import get_infection_data, filter_infection_data
-from covid19.stats import build_summary_stats
-from covid19.types import InfectionStatus
+from flask import Flask, request, Response
+from plotly.io.json import to_json_plotly
+
+from covid19 import callbacks as cb, metrics
+from covid19.layout import metric_labels
+from covid19.payloads import PayloadCache, placeholder, splice_json
+from covid19.refresh import build_snapshot, Snapshot, SnapshotRefresher
+from covid19.snapshot import shared_snapshot
+from covid19.types import FigureInstance, InfectionStatus, Summary
 from covid19.utils import get_app_dir, read_config
 
 logger = getLogger(__name__)
@@ -24,14 +26,18 @@ app_dir = get_app_dir()
 with open(str(app_dir / "assets" / "header.md")) as header_file:
     header_md = header_file.read()
 
-raw_infection_data = get_infection_data()
-infection_data = filter_infection_data(raw_infection_data)
-summary_data = build_summary_stats(infection_data)
-graphic = p.Graphic(infection_data)
-plots = graphic.figures[default_infection_status]
+clientside_highlight = config_file["highlight"]["clientside"]
+refresh_interval = config_file["refresh"]["interval"]
+snapshot_builder = build_snapshot
+if config_file["snapshot"]["shared"]:
+    snapshot_builder = shared_snapshot(app_dir / config_file["snapshot"]["directory"],
+                                       refresh_interval)
+with profiler.phase("snapshot"):
+    refresher = SnapshotRefresher(snapshot_builder, refresh_interval).start()
+    plots = refresher.snapshot.graphic.figures[default_infection_status]
 
 
-def generate_stats_panel() -> list:
+def generate_stats_panel(summary_data: Summary) -> list:
     """Build a div with top level statistics"""
     panel_list = []
     for label in summary_data.__dict__:
@@ -48,65 +54,166 @@ def generate_callback_params() -> Tuple[List[dash.dependencies.Output],
                                         List[dash.dependencies.Input]]:
     """Generate a list of inputs and outputs for the callback method"""
     output_deps, input_deps = [], []
+    extra_outputs = [dash.dependencies.Output("highlight_state", "data")]
     extra_inputs = [dash.dependencies.Input("radio_select", "value")]
-    for v in plots.__dict__:
-        if v not in ["data", "kind"]:
-            viz = getattr(plots, v)
-            output_deps.append(dash.dependencies.Output(viz.id_str, "figure"))
-            input_deps.append(dash.dependencies.Input(viz.id_str, "hoverData"))
+    for viz in plots.instances():
+        output_deps.append(dash.dependencies.Output(viz.id_str, "figure"))
+        input_deps.append(dash.dependencies.Input(viz.id_str, "hoverData"))
     for extra in extra_inputs:
         input_deps.append(extra)
+    for extra in extra_outputs:
+        output_deps.append(extra)
     return output_deps, input_deps
 
 
 server = Flask(__name__)
 app = dash.Dash(__name__, server=server)
 app.title = config_file["title"]
-app.layout = html.Div(children=[
-    html.Div(children=[
-        html.Div([html.P(children=config_file["title"])], className="title"),
-        html.Div([dcc.Markdown(header_md)], className="desc"),
-        html.Div(children=[
-            html.P("Select metric", id="selector_title"),
-            dcc.RadioItems(id="radio_select",
-                           labelStyle={"display": "table-row"},
-                           options=[
-                               {"label": "Cases", "value": InfectionStatus.CONFIRMED.value},
-                               {"label": "Deaths", "value": InfectionStatus.DEATHS.value},
-                           ], value=default_infection_status)
-        ], className="select_container"),
-    ], className="top_text"),
-    html.Div(children=generate_stats_panel(), className="stat_panel"),
-    html.Div(children=[
+
+
+def callback_trigger() -> str:
+    """Id of the component that triggered the current callback"""
+    return str(dash.callback_context.triggered_id or "initial")
+
+
+if config_file["metrics"]["enabled"]:
+    @server.route("/metrics")
+    def serve_metrics() -> Response:
+        """Callback and highlight metrics of this worker in the Prometheus text format"""
+        return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+    @server.after_request
+    def record_callback_response(response: Response) -> Response:
+        """Record the size of every callback response by trigger"""
+        if request.path.endswith("_dash-update-component"):
+            size = response.calculate_content_length()
+            metrics.record_response(request.get_json(silent=True),
+                                    len(response.get_data()) if size is None else size)
+        return response
+
+
+def serve_layout() -> html.Div:
+    """
+    Build the page from the snapshot in service, so that new visitors see refreshed data
+    """
+    return page_layout(refresher.snapshot)
+
+
+def page_layout(snapshot: Snapshot,
+                figure: Callable[[FigureInstance], Any] = lambda instance: instance.figure
+                ) -> html.Div:
+    """
+    Build the page of a snapshot
+    :param snapshot: snapshot to show
+    :param figure: value of the figure property of each graph
+    :return: page layout
+    """
+    plots = snapshot.graphic.figures[default_infection_status]
+    return html.Div(children=[
         html.Div(children=[
-            dcc.Graph(figure=plots.map.figure, id=plots.map.id_str, clear_on_unhover=True),
-            dcc.Graph(figure=plots.bars.figure, id=plots.bars.id_str, clear_on_unhover=True),
-        ], className="left_side"),
+            html.Div([html.P(children=config_file["title"])], className="title"),
+            html.Div([dcc.Markdown(header_md)], className="desc"),
+            html.Div(children=[
+                html.P("Select metric", id="selector_title"),
+                dcc.RadioItems(id="radio_select",
+                               labelStyle={"display": "table-row"},
+                               options=[{"label": metric_labels[metric], "value": metric}
+                                        for metric in snapshot.graphic.figures],
+                               value=default_infection_status)
+            ], className="select_container"),
+        ], className="top_text"),
+        html.Div(children=generate_stats_panel(snapshot.summary), className="stat_panel"),
         html.Div(children=[
-            dcc.Graph(figure=plots.curve.figure, id=plots.curve.id_str, clear_on_unhover=True),
-            html.Div(id="right_separator"),
-            dcc.Graph(figure=plots.trend.figure, id=plots.trend.id_str, clear_on_unhover=True),
-        ], className="right_side"),
-    ], className="infection_graphs")
-], className="dash_container")
+            html.Div(children=[
+                dcc.Graph(figure=figure(plots.map), id=plots.map.id_str,
+                          clear_on_unhover=True),
+                dcc.Graph(figure=figure(plots.bars), id=plots.bars.id_str,
+                          clear_on_unhover=True),
+            ], className="left_side"),
+            html.Div(children=[
+                dcc.Graph(figure=figure(plots.curve), id=plots.curve.id_str,
+                          clear_on_unhover=True),
+                html.Div(id="right_separator"),
+                dcc.Graph(figure=figure(plots.trend), id=plots.trend.id_str,
+                          clear_on_unhover=True),
+            ], className="right_side"),
+        ], className="infection_graphs"),
+        dcc.Store(id="highlight_state", data={"metric": default_infection_status,
+                                              "country": None,
+                                              "snapshot": snapshot.created.isoformat()}),
+        dcc.Store(id="highlight_index",
+                  data=highlight_index(snapshot, default_infection_status)
+                  if clientside_highlight else None),
+    ], className="dash_container")
+
+
+def highlight_index(snapshot: Snapshot, metric: str) -> dict:
+    """Lookup tables for clientside highlighting of the figures of a metric"""
+    return cb.client_highlight_index(snapshot.graphic.figures[metric].instances(),
+                                     token=f"{metric}@{snapshot.created.isoformat()}")
+
+
+def serialize_layout(snapshot: Snapshot) -> bytes:
+    """Page of a snapshot as JSON, with the pre-serialized figures spliced in"""
+    plots = snapshot.graphic.figures[default_infection_status]
+    page = page_layout(snapshot, figure=lambda instance: placeholder(instance.id_str))
+    return splice_json(to_json_plotly(page),
+                       {instance.id_str: instance.json for instance in plots.instances()})
+
+
+app.layout = serve_layout
+
+if config_file["layout_cache"]["enabled"]:
+    layout_payloads = PayloadCache(serialize_layout,
+                                   config_file["layout_cache"]["encodings"])
+
+    @server.before_request
+    def serve_cached_layout() -> Optional[Response]:
+        """Serve the page of the snapshot in service pre-serialized and precompressed"""
+        if request.path == f"{app.config.routes_pathname_prefix}_dash-layout":
+            return layout_payloads[refresher.snapshot].response(request)
 
 fig_outputs, fig_inputs = generate_callback_params()
 
 
-@app.callback(fig_outputs, fig_inputs)
+@metrics.instrumented_callback(callback_trigger)
 def infection_plot_actions(hover_curve, hover_trend, hover_bars,
-                           hover_map, radio_value) -> [go.Figure, go.Figure]:
-    plot = graphic.figures[radio_value]
-    hover_context = [(plot.curve, hover_curve), (plot.trend, hover_trend),
-                     (plot.bars, hover_bars),   (plot.map, hover_map)]
-    for fig, _, in hover_context:
-        fig.reset(fig.figure)
-    if any([h for _, h in hover_context]):
-        logger.debug("highlight action triggered")
-        if country := cb.find_selected_country(hover_context):
-            for fig, _ in hover_context:
-                fig.highlight(fig.figure, country)
-    return [f.figure for f, _ in hover_context]
+                           hover_map, radio_value, highlight_state) -> list:
+    """Highlight the hovered country"""
+    snapshot = refresher.snapshot
+    plot = snapshot.graphic.figures[radio_value]
+    return cb.plot_actions(plot.instances(),
+                           [hover_curve, hover_trend, hover_bars, hover_map],
+                           radio_value, snapshot.created.isoformat(), highlight_state,
+                           switched=dash.callback_context.triggered_id == "radio_select")
+
+
+@metrics.instrumented_callback(callback_trigger)
+def switch_metric(radio_value) -> list:
+    """In clientside highlighting mode, the server only swaps figures on metric changes"""
+    snapshot = refresher.snapshot
+    plot = snapshot.graphic.figures[radio_value]
+    return ([fig.render() for fig in plot.instances()]
+            + [highlight_index(snapshot, radio_value)])
+
+
+if clientside_highlight:
+    app.clientside_callback(
+        dash.dependencies.ClientsideFunction(namespace="covid19",
+                                             function_name="highlight"),
+        dash.dependencies.Output("highlight_state", "data"),
+        fig_inputs[:-1],
+        [dash.dependencies.State("highlight_index", "data"),
+         dash.dependencies.State("highlight_state", "data")],
+        prevent_initial_call=True)
+    app.callback(fig_outputs[:-1] + [dash.dependencies.Output("highlight_index", "data")],
+                 fig_inputs[-1:], prevent_initial_call=True)(switch_metric)
+else:
+    app.callback(fig_outputs, fig_inputs,
+                 [dash.dependencies.State("highlight_state", "data")],
+                 prevent_initial_call=True)(infection_plot_actions)
+
+profiler.finish()
 
 
 if __name__ == '__main__':
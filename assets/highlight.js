@@ -0,0 +1,137 @@
+/* Clientside hover highlighting, mirroring covid19/callbacks.py (enabled by highlight.clientside) */
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    covid19: {
+        highlight: function (hoverCurve, hoverTrend, hoverBars, hoverMap, index, state) {
+            const noUpdate = window.dash_clientside.no_update;
+            if (!index || !window.Plotly) {
+                return noUpdate;
+            }
+            const hovers = {
+                infection_curve: hoverCurve,
+                infection_trend: hoverTrend,
+                infected_countries: hoverBars,
+                infection_map: hoverMap,
+            };
+            const country = findSelectedCountry(hovers, index);
+            const previous = state && state.token === index.token ? state.country : null;
+            if (country === previous) {
+                return noUpdate;
+            }
+            for (const [id, figure] of Object.entries(index.figures)) {
+                const graph = graphDiv(id);
+                if (graph) {
+                    restyle[figure.type](graph, figure, index, previous, country);
+                }
+            }
+            return {token: index.token, country: country};
+        },
+    },
+});
+
+function graphDiv(id) {
+    const container = document.getElementById(id);
+    if (!container || container.classList.contains("js-plotly-plot")) {
+        return container;
+    }
+    return container.querySelector(".js-plotly-plot");
+}
+
+function positions(figure) {
+    if (!figure.positions) {
+        figure.positions = new Map(figure.names.map((name, position) => [name, position]));
+        for (const [alias, name] of Object.entries(figure.aliases || {})) {
+            figure.positions.set(alias, figure.positions.get(name));
+        }
+    }
+    return figure.positions;
+}
+
+function findSelectedCountry(hovers, index) {
+    for (const [id, hover] of Object.entries(hovers)) {
+        if (!hover || !index.figures[id]) {
+            continue;
+        }
+        const point = hover.points[0];
+        const figure = index.figures[id];
+        if (figure.type === "bars") {
+            return point.x;
+        } else if (figure.type === "map") {
+            return (figure.originals || {})[point.location] || point.location;
+        }
+        const country = figure.type === "merged" ? point.customdata : figure.names[point.curveNumber];
+        if (country !== undefined && !index.exclude.includes(country)) {
+            return country;
+        }
+    }
+    return null;
+}
+
+const typedArrays = {
+    f8: Float64Array, f4: Float32Array, i4: Int32Array, u4: Uint32Array,
+    i2: Int16Array, u2: Uint16Array, i1: Int8Array, u1: Uint8Array,
+};
+
+function decodeArray(values) {
+    if (!values || !values.bdata) {
+        return values;
+    }
+    const bytes = Uint8Array.from(atob(values.bdata), (c) => c.charCodeAt(0));
+    return new typedArrays[values.dtype](bytes.buffer);
+}
+
+const restyle = {
+    lines: function (graph, figure, index, previous, country) {
+        for (const [name, style] of [[previous, index.styles.default], [country, index.styles.highlight]]) {
+            const position = positions(figure).get(name);
+            if (position !== undefined) {
+                window.Plotly.restyle(graph, {
+                    "line.color": style.line.color,
+                    "line.width": style.line.width,
+                    "opacity": style.opacity,
+                }, [position]);
+            }
+        }
+    },
+    bars: function (graph, figure, index, previous, country) {
+        const colors = figure.names.map(() => index.styles.default.line.color);
+        const position = positions(figure).get(country);
+        if (position !== undefined) {
+            colors[position] = index.styles.highlight.line.color;
+        }
+        window.Plotly.restyle(graph, {"marker.color": [colors]}, [0]);
+    },
+    merged: function (graph, figure, index, previous, country) {
+        if (graph.data.length > figure.traces) {
+            window.Plotly.deleteTraces(graph, figure.traces);
+        }
+        const position = positions(figure).get(country);
+        if (position !== undefined) {
+            const [start, stop] = figure.segments[position];
+            const lines = graph.data[0];
+            const overlay = Object.assign({}, figure.overlay, {
+                name: country,
+                x: Array.from(decodeArray(lines.x).slice(start, stop)),
+                y: Array.from(decodeArray(lines.y).slice(start, stop)),
+                customdata: Array.from(decodeArray(lines.customdata).slice(start, stop)),
+            });
+            if (figure.details) {
+                overlay.meta = figure.details[position];
+            }
+            window.Plotly.addTraces(graph, overlay);
+        }
+    },
+    map: function (graph, figure, index, previous, country) {
+        if (graph.data.length > 1) {
+            window.Plotly.deleteTraces(graph, 1);
+        }
+        const position = positions(figure).get(country);
+        if (position !== undefined) {
+            window.Plotly.addTraces(graph, Object.assign({}, figure.overlay, {
+                locations: [figure.names[position]],
+                z: [figure.z[position]],
+                hovertext: [figure.hovertext[position]],
+            }));
+        }
+    },
+};
@@ -0,0 +1,181 @@
+"""
+Compact single-file archive of the raw infection data, written after every fetch so that
+a worker can start from local disk without parsing the payload. An archive is a fixed
+prefix (magic, format version, flags, header length), a JSON header describing the date
+axis, the country table and the columns, and the columns themselves: the observed mask and
+one count column per infection status, as int32 unless the counts do not fit. Columns are
+aligned so that uncompressed archives are mapped and read without copying; compressed
+archives (zlib, column by column) are smaller but decompressed on load. To build one from
+a timeseries.json file:
+
+    python -m covid19.archive timeseries.json infections.c19 --compress
+"""
+
+import argparse
+import json
+import mmap
+import struct
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from covid19.data import CHUNK_SIZE, InfectionStore
+from covid19.ingest import parse_infections
+from covid19.types import InfectionStatus
+from covid19.utils import atomic_write
+
+MAGIC = b"C19A"
+FORMAT_VERSION = 1
+PREFIX = struct.Struct("<4sHHI")
+ALIGNMENT = 64
+COMPRESSED = 1
+
+
+def count_dtype(values: np.ndarray) -> np.dtype:
+    """Smallest of int32 and int64 holding every count"""
+    info = np.iinfo(np.int32)
+    fits = values.size == 0 or info.min <= values.min() and values.max() <= info.max
+    return np.dtype("<i4" if fits else "<i8")
+
+
+def padding(size: int) -> bytes:
+    """Zero bytes aligning the next column after size bytes"""
+    return bytes(-size % ALIGNMENT)
+
+
+def encode_archive(store: InfectionStore,
+                   compress: bool = False,
+                   source: Optional[dict] = None) -> List[bytes]:
+    """
+    Lay out a store in the archive format
+    :param store: raw infection store (derived series are not archived)
+    :param compress: compress every column with zlib
+    :param source: describes what the store was built from, e.g. the payload it was parsed
+    from
+    :return: the archive in pieces
+    """
+    kinds = [kind for kind in InfectionStatus if kind in store.counts]
+    arrays = [("dates", np.ascontiguousarray(store.dates, dtype="<M8[D]")),
+              ("observed", np.ascontiguousarray(store.observed, dtype=bool))]
+    arrays += [(kind.value, np.ascontiguousarray(store.counts[kind],
+                                                 dtype=count_dtype(store.counts[kind])))
+               for kind in kinds]
+    columns, blocks, offset = [], [], 0
+    for name, values in arrays:
+        block = values.tobytes()
+        if compress:
+            block = zlib.compress(block)
+        columns.append({"name": name, "dtype": values.dtype.str,
+                        "shape": list(values.shape), "offset": offset,
+                        "size": len(block)})
+        blocks += [block, padding(len(block))]
+        offset += len(block) + len(padding(len(block)))
+    header = json.dumps({"countries": store.countries,
+                         "kinds": [kind.value for kind in kinds],
+                         "columns": columns,
+                         "source": source}).encode()
+    flags = COMPRESSED if compress else 0
+    prefix = PREFIX.pack(MAGIC, FORMAT_VERSION, flags, len(header)) + header
+    return [prefix, padding(len(prefix)), *blocks]
+
+
+def write_archive(store: InfectionStore,
+                  path: Path,
+                  compress: bool = False,
+                  source: Optional[dict] = None) -> Path:
+    """
+    Write a store to an archive file, replacing any previous one atomically
+    :param store: raw infection store
+    :param path: archive file
+    :param compress: compress every column with zlib
+    :param source: describes what the store was built from
+    :return: the archive file
+    """
+    atomic_write(path, encode_archive(store, compress, source))
+    return path
+
+
+def parse_prefix(buffer) -> Tuple[int, dict, int]:
+    """
+    Read the prefix and header of an archive
+    :param buffer: the archive, or at least its prefix and header
+    :return: flags, header and position of the first column
+    :raise ValueError: if this is not an archive of a supported version
+    """
+    if len(buffer) < PREFIX.size:
+        raise ValueError("archive is truncated")
+    magic, version, flags, header_size = PREFIX.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError("not an infection archive")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"unsupported archive version {version} "
+                         f"(expected {FORMAT_VERSION})")
+    end = PREFIX.size + header_size
+    if len(buffer) < end:
+        raise ValueError("archive is truncated")
+    header = json.loads(bytes(buffer[PREFIX.size:end]))
+    return flags, header, end + len(padding(end))
+
+
+def read_header(path: Path) -> dict:
+    """
+    Header of an archive file, without reading its columns
+    :param path: archive file
+    :return: header
+    :raise ValueError: if this is not an archive of a supported version
+    """
+    with open(str(path), "rb") as archive:
+        prefix = archive.read(PREFIX.size)
+        if len(prefix) == PREFIX.size:
+            prefix += archive.read(PREFIX.unpack(prefix)[3])
+        return parse_prefix(prefix)[1]
+
+
+def read_archive(path: Path) -> InfectionStore:
+    """
+    Load an archive file. The columns of uncompressed archives are read-only views of
+    the mapped file; those of compressed archives are decompressed into memory
+    :param path: archive file
+    :return: raw infection store
+    :raise ValueError: if this is not an archive of a supported version
+    """
+    with open(str(path), "rb") as archive:
+        buffer = mmap.mmap(archive.fileno(), 0, access=mmap.ACCESS_READ)
+    flags, header, start = parse_prefix(buffer)
+    columns: Dict[str, np.ndarray] = {}
+    for column in header["columns"]:
+        dtype, shape = np.dtype(column["dtype"]), tuple(column["shape"])
+        offset = start + column["offset"]
+        if offset + column["size"] > len(buffer):
+            raise ValueError("archive is truncated")
+        if flags & COMPRESSED:
+            block = zlib.decompress(buffer[offset:offset + column["size"]])
+            columns[column["name"]] = np.frombuffer(block, dtype=dtype).reshape(shape)
+        else:
+            columns[column["name"]] = np.ndarray(shape, dtype=dtype, buffer=buffer,
+                                                 offset=offset)
+    return InfectionStore(countries=header["countries"],
+                          dates=columns["dates"],
+                          counts={InfectionStatus(kind): columns[kind]
+                                  for kind in header["kinds"]},
+                          observed=columns["observed"])
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Build an infection archive from a "
+                                                 "timeseries.json file")
+    parser.add_argument("source", type=Path, help="timeseries.json file")
+    parser.add_argument("destination", type=Path, help="archive file to write")
+    parser.add_argument("--compress", action="store_true", help="compress the columns")
+    options = parser.parse_args(args)
+    with open(str(options.source), "rb") as source:
+        store = parse_infections(iter(lambda: source.read(CHUNK_SIZE), b""))
+    write_archive(store, options.destination, options.compress)
+    print(f"{options.destination}: {len(store.countries)} countries, "
+          f"{len(store.dates)} dates, {options.destination.stat().st_size} bytes")
+
+
+if __name__ == "__main__":
+    main()
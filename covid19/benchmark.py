@@ -0,0 +1,313 @@
+"""
+Benchmarks of data ingest, statistics, figure building and the highlight callback on
+synthetic datasets in the timeseries.json format, at scaled sizes. Results are written as
+JSON so that runs can be compared across commits:
+
+    python -m covid19.benchmark --sizes small medium --output benchmark.json
+    python -m covid19.benchmark --compare benchmark.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+from dataclasses import asdict, dataclass, replace
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import dash
+import numpy as np
+import plotly
+from dash.exceptions import PreventUpdate
+from plotly.io.json import to_json_plotly
+
+from covid19 import callbacks as cb
+from covid19.data import CHUNK_SIZE, filter_infection_data, InfectionStore, RankingIndex
+from covid19.ingest import parse_infections
+from covid19.plots import (FigureSet, Graphic, plot_infected_countries,
+                           plot_infection_curve, plot_infection_map,
+                           plot_infection_trends)
+from covid19.stats import build_growth_models, build_summary_stats, fit_infection_trend
+from covid19.types import HoverData, Infections, InfectionStatus
+from covid19.utils import get_app_dir, read_config
+
+config = read_config()
+
+
+@dataclass
+class Scale:
+    """Size of a synthetic dataset"""
+    countries: int
+    days: int
+    regions: int = 0
+
+
+SCALES = {
+    "small": Scale(countries=60, days=120),
+    "medium": Scale(countries=190, days=450),
+    "large": Scale(countries=190, days=1100),
+    "regions": Scale(countries=190, days=450, regions=5),
+}
+
+
+def synthetic_infections(scale: Scale, seed: int = 0) -> Infections:
+    """
+    Generate logistic outbreaks with noisy daily counts and occasional downward
+    corrections, in the timeseries.json format. The anchor and excluded countries of the
+    config are always present; with regions, every country is also reported as that many
+    sub-national series
+    :param scale: number of countries, days and regions per country
+    :param seed: random seed, the same seed always gives the same data
+    :return: a dictionary of countries with a list of dates and counts
+    """
+    rng = np.random.RandomState(seed)
+    named = [config["anchor"], *config["exclude"]["trend"]]
+    names = named + [f"Country {number:03d}"
+                     for number in range(scale.countries - len(named))]
+    names += [f"{country} / Region {region:02d}"
+              for country in names for region in range(scale.regions)]
+    first = date(2020, 1, 22)
+    dates = [f"{day.year}-{day.month}-{day.day}"
+             for day in (first + timedelta(days=offset) for offset in range(scale.days))]
+    days = np.arange(scale.days)
+    infection_data = {}
+    for name in names:
+        size = 10 ** rng.uniform(3, 7)
+        midpoint = rng.uniform(0.2, 0.8) * scale.days
+        rate = rng.uniform(0.03, 0.3)
+        expected = np.diff(size / (1 + np.exp(-rate * (days - midpoint))), prepend=0)
+        daily = rng.poisson(expected)
+        if rng.uniform() < 0.1:
+            day = rng.randint(scale.days)
+            daily[day] -= min(daily[:day + 1].sum(), rng.randint(1, 100))
+        confirmed = daily.cumsum()
+        lagged = np.pad(confirmed, (14, 0))[:scale.days]
+        deaths = np.floor(lagged * rng.uniform(0.005, 0.04))
+        infection_data[name] = [{"date": day, "confirmed": int(c), "deaths": int(d),
+                                 "recovered": 0}
+                                for day, c, d in zip(dates, confirmed, deaths)]
+    return infection_data
+
+
+def hover_events(figure_set: FigureSet, count: int, seed: int = 0
+                 ) -> Iterator[List[Optional[HoverData]]]:
+    """
+    Hover data of a user moving across the figures: each event hovers a random country
+    of one figure, cycling through the figures
+    :param figure_set: figures being hovered
+    :param count: number of events
+    :param seed: random seed
+    :return: hover data of every figure (None for the figures not hovered) per event
+    """
+    rng = np.random.RandomState(seed)
+    instances = figure_set.instances()
+    for event in range(count):
+        position = event % len(instances)
+        names = instances[position].client_index["names"]
+        choice = rng.randint(len(names))
+        points = {"lines": {"curveNumber": choice},
+                  "merged": {"customdata": names[choice]},
+                  "bars": {"x": names[choice]},
+                  "map": {"location": names[choice]}}
+        point = points[instances[position].client_index["type"]]
+        hovers: List[Optional[HoverData]] = [None] * len(instances)
+        hovers[position] = {"points": [point]}
+        yield hovers
+
+
+def measure(function: Callable[[], object], repeat: int, warmup: int = 1) -> List[float]:
+    """Wall times of repeated calls, after the warmup calls"""
+    for _ in range(warmup):
+        function()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def summarize(timings: List[float]) -> dict:
+    """Distribution of wall times, in seconds"""
+    return {"repeat": len(timings),
+            "min": float(np.min(timings)),
+            "median": float(np.median(timings)),
+            "mean": float(np.mean(timings)),
+            "p95": float(np.percentile(timings, 95)),
+            "max": float(np.max(timings))}
+
+
+def hover_latency(figure_set: FigureSet, hovers: int) -> Tuple[List[float], List[int]]:
+    """
+    Replay hover events through the highlight callback, serializing every response
+    the way Dash does
+    :param figure_set: figures of the selected metric
+    :param hovers: number of hover events
+    :return: latency and response size of every event that produced a response
+    """
+    instances = figure_set.instances()
+    metric = figure_set.kind.value
+    state = {"metric": metric, "country": None, "snapshot": "benchmark"}
+    timings, sizes = [], []
+    for event in hover_events(figure_set, hovers):
+        start = time.perf_counter()
+        try:
+            outputs = cb.plot_actions(instances, event, metric, "benchmark", state)
+        except PreventUpdate:
+            continue
+        response = to_json_plotly(outputs)
+        timings.append(time.perf_counter() - start)
+        sizes.append(len(response))
+        state = outputs[-1]
+    return timings, sizes
+
+
+def run_scale(scale: Scale,
+              repeat: int,
+              hovers: int,
+              merged: bool = config["figures"]["merged_lines"]
+              ) -> Iterator[Tuple[str, dict]]:
+    """
+    Benchmark every stage of the app on a synthetic dataset
+    :param scale: dataset size
+    :param repeat: number of timed calls per benchmark
+    :param hovers: number of hover events replayed through the highlight callback
+    :param merged: the callbacks are benchmarked on merged line figures
+    :return: benchmark names with their timings (and sizes where relevant)
+    """
+    kind = InfectionStatus.CONFIRMED
+    window = config["growth"]["window"]
+    infection_data = synthetic_infections(scale)
+    body = json.dumps(infection_data).encode()
+    raw = InfectionStore.from_infections(infection_data)
+    derived = raw.derive(config["series"]["window"])
+    store = derived.filter()
+    growth = build_growth_models(store, window)
+
+    stages = {
+        "ingest/parse": lambda: json.loads(body),
+        "ingest/store": lambda: InfectionStore.from_infections(infection_data),
+        "ingest/stream": lambda: parse_infections(
+            body[start:start + CHUNK_SIZE] for start in range(0, len(body), CHUNK_SIZE)),
+        "ingest/derive": lambda: raw.derive(config["series"]["window"]),
+        "filter/filter_infection_data": lambda: filter_infection_data(infection_data,
+                                                                      kind),
+        "filter/store": lambda: replace(derived).filter(),
+        "rank/ranking_index": lambda: RankingIndex.build(store.counts[kind],
+                                                         store.observed),
+        "rank/top": lambda: store.ranking(kind).top(20, len(store.dates) // 2),
+        "stats/fit_infection_trend": lambda: fit_infection_trend(kind, store),
+        "stats/build_growth_models": lambda: build_growth_models(store, window),
+        "stats/build_summary_stats": lambda: build_summary_stats(store,
+                                                                 growth[kind.value]),
+        "plots/plot_infection_curve": lambda: plot_infection_curve(store, kind),
+        "plots/plot_infection_trends": lambda: plot_infection_trends(
+            store, kind, growth=growth[kind.value]),
+        "plots/plot_infection_curve[merged]": lambda: plot_infection_curve(store, kind,
+                                                                           merged=True),
+        "plots/plot_infection_trends[merged]": lambda: plot_infection_trends(
+            store, kind, growth=growth[kind.value], merged=True),
+        "plots/plot_infected_countries": lambda: plot_infected_countries(store, kind),
+        "plots/plot_infection_map": lambda: plot_infection_map(store, kind),
+        "graphic/construct": lambda: Graphic(store, growth),
+        "graphic/figure_set": lambda: Graphic(store, growth).figures[kind.value],
+    }
+    for name, stage in stages.items():
+        yield name, summarize(measure(stage, repeat))
+
+    figure_set = FigureSet(store, kind, growth[kind.value], merged)
+    figures = {instance.id_str: instance.figure for instance in figure_set.instances()}
+
+    def first_hover():
+        fresh = FigureSet.from_figures(store, kind, figures, growth[kind.value], merged)
+        hover_latency(fresh, 1)
+
+    yield "callback/first_hover", summarize(measure(first_hover, repeat))
+    switch_state = {"metric": kind.value, "country": None, "snapshot": "benchmark"}
+    responses = []
+
+    def switch():
+        outputs = cb.plot_actions(figure_set.instances(), [None] * 4, kind.value,
+                                  "benchmark", switch_state, switched=True)
+        responses.append(len(to_json_plotly(outputs)))
+
+    yield "callback/switch_metric", {**summarize(measure(switch, repeat)),
+                                     "response_bytes": responses[-1]}
+    hover_latency(figure_set, hovers)
+    timings, sizes = hover_latency(figure_set, hovers)
+    yield "callback/hover", {**summarize(timings),
+                             "throughput": len(timings) / sum(timings),
+                             "response_bytes": float(np.mean(sizes))}
+
+
+def git_commit() -> Optional[str]:
+    """Commit of the working tree, with a -dirty suffix if it has changes"""
+    try:
+        commit = subprocess.run(["git", "describe", "--always", "--dirty"],
+                                cwd=get_app_dir(),
+                                capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.stdout.strip()
+
+
+def run(scales: Dict[str, Scale], repeat: int, hovers: int) -> dict:
+    """
+    Run the benchmarks on every dataset
+    :param scales: dataset sizes by name
+    :param repeat: number of timed calls per benchmark
+    :param hovers: number of hover events replayed through the highlight callback
+    :return: results along with the environment they were measured in
+    """
+    results = {
+        "commit": git_commit(),
+        "created": datetime.utcnow().isoformat(),
+        "environment": {"python": platform.python_version(),
+                        "machine": platform.machine(),
+                        "numpy": np.__version__, "plotly": plotly.__version__,
+                        "dash": dash.__version__},
+        "datasets": {},
+        "benchmarks": [],
+    }
+    for dataset, scale in scales.items():
+        results["datasets"][dataset] = {**asdict(scale),
+                                        "series": scale.countries * (1 + scale.regions)}
+        for name, timings in run_scale(scale, repeat, hovers):
+            results["benchmarks"].append({"dataset": dataset, "name": name, **timings})
+            print(f"{dataset:>8} {name:<40} {timings['median'] * 1000:>10.3f} ms")
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    """Print the ratio of median times to those of a baseline run"""
+    medians = {(entry["dataset"], entry["name"]): entry["median"]
+               for entry in baseline["benchmarks"]}
+    print(f"compared with {baseline.get('commit')}")
+    for entry in results["benchmarks"]:
+        if before := medians.get((entry["dataset"], entry["name"])):
+            ratio = entry["median"] / before
+            print(f"{entry['dataset']:>8} {entry['name']:<40} {ratio:>7.2f}x")
+
+
+def main(args: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=SCALES, default=["small", "medium"],
+                        help="datasets to run the benchmarks on")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per benchmark")
+    parser.add_argument("--hovers", type=int, default=200, help="hover events to replay")
+    parser.add_argument("--output", type=Path, default=Path("benchmark.json"),
+                        help="file to write the results to")
+    parser.add_argument("--compare", type=Path, help="results of a previous run")
+    options = parser.parse_args(args)
+    baseline = json.loads(options.compare.read_text()) if options.compare else None
+    results = run({size: SCALES[size] for size in options.sizes}, options.repeat,
+                  options.hovers)
+    options.output.write_text(json.dumps(results, indent=2))
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,75 +1,246 @@
 """Callback support methods"""
 
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
 
+import numpy as np
 import plotly.graph_objects as go
+from dash import Patch
+from dash.exceptions import PreventUpdate
 
-from covid19.layout import styles, map_hover_template
+from covid19.layout import styles
+from covid19.metrics import instrumented
 from covid19.types import HoverData, FigureInstance
-from covid19.utils import read_config
+from covid19.utils import get_country_translator, read_config
 
 config = read_config()
 
 
-def reset_lines(fig: go.Figure) -> go.Figure:
-    """Reset lines of the infection plots"""
-    for trace in fig.data:
-        if trace["name"] not in config["exclude"]["trace"]:
-            trace["line"]["color"] = styles.default.color
-            trace["line"]["width"] = styles.default.line_width
-            trace["opacity"] = styles.default.opacity
-    return fig
+def number(text: Union[str, int, float]) -> Union[int, float]:
+    """Numeric value of a hover text, integral values as int"""
+    value = float(text)
+    return int(value) if value.is_integer() else value
 
 
-def reset_bars(fig: go.Figure) -> go.Figure:
-    """Reset bar plots"""
-    fig.data[0].marker.color = styles.default.color
-    return fig
+def line_style(highlighted: bool) -> dict:
+    """Trace properties of a default or a highlighted line"""
+    style = styles.highlight if highlighted else styles.default
+    return {"line": {"color": style.color, "width": style.line_width},
+            "opacity": style.opacity}
 
 
-def reset_map(fig: go.Figure) -> go.Figure:
-    """Reset world map"""
-    if fig.data[0]:
-        fig.data = [fig.data[0]]
-    return fig
+def bar_colors(fig: FigureInstance, country: Optional[str]) -> Optional[list]:
+    """Bar colors with the given country highlighted, None if it has no bar"""
+    if (position := fig.position(country)) is not None:
+        cols = [styles.default.color] * len(fig.client_index["names"])
+        cols[position] = styles.highlight.color
+        return cols
 
 
-def highlight_lines(fig: go.Figure, country: str) -> go.Figure:
+def map_overlay_style(hovertemplate: str) -> dict:
+    """Properties of the choropleth trace drawn over a highlighted country"""
+    return {
+        "type": "choropleth", "locationmode": "country names", "text": "Highlight",
+        "hoverlabel": {"bgcolor": styles.default.background_color},
+        "marker": {"line": {"color": styles.highlight.map_outline_color}},
+        "colorscale": [[0, styles.highlight.color], [1, styles.highlight.color]],
+        "showscale": False, "hovertemplate": hovertemplate,
+    }
+
+
+def map_overlay(fig: FigureInstance, country: Optional[str]) -> Optional[dict]:
+    """Choropleth trace drawn over a highlighted country, None if it is not on the map"""
+    if (position := fig.position(country)) is not None:
+        index = fig.client_index
+        return {
+            **index["overlay"],
+            "locations": [index["names"][position]], "z": [index["z"][position]],
+            "hovertext": [index["hovertext"][position]],
+        }
+
+
+def merged_overlay_style(hovertemplate: str) -> dict:
+    """Properties of the line drawn over merged lines to highlight a country"""
+    return {"type": "scattergl", "mode": "lines", "showlegend": False,
+            "hovertemplate": hovertemplate, **line_style(highlighted=True)}
+
+
+def merged_overlay(fig: FigureInstance, country: Optional[str]) -> Optional[dict]:
+    """Line of a country drawn over merged lines, None if the country has no line"""
+    if (position := fig.position(country)) is not None:
+        index = fig.client_index
+        start, stop = index["segments"][position]
+        lines = fig.figure.data[0]
+        overlay = {**index["overlay"], "name": country, "x": lines.x[start:stop],
+                   "y": lines.y[start:stop], "customdata": lines.customdata[start:stop]}
+        if details := index.get("details"):
+            overlay["meta"] = details[position]
+        return overlay
+
+
+def overlay_trace(base: dict, index: int, changes: dict) -> dict:
+    """
+    Copy a serialized figure, changing properties of a single trace. Only the trace
+    list, the changed trace and its changed nested properties are copied; everything
+    else is shared
+    :param base: serialized figure (left untouched)
+    :param index: position of the trace to change
+    :param changes: properties to set; dictionaries are merged into the existing property
+    :return: serialized figure with the changes applied
+    """
+    data = list(base["data"])
+    trace = dict(data[index])
+    for key, value in changes.items():
+        trace[key] = {**trace.get(key, {}), **value} if isinstance(value, dict) else value
+    data[index] = trace
+    return {**base, "data": data}
+
+
+@instrumented
+def highlight_lines(fig: FigureInstance, country: str) -> dict:
     """Highlight lines of the infection plots"""
-    if index := [i for i, c in enumerate(fig.data) if c["name"] == country]:
-        fig.data[index[0]]["line"]["color"] = styles.highlight.color
-        fig.data[index[0]]["line"]["width"] = styles.highlight.line_width
-        fig.data[index[0]]["opacity"] = styles.highlight.opacity
-        return fig
+    if (index := fig.position(country)) is not None:
+        return overlay_trace(fig.base, index, line_style(highlighted=True))
+    return fig.base
 
 
-def highlight_map(fig: go.Figure, country: str) -> go.Figure:
+@instrumented
+def highlight_map(fig: FigureInstance, country: str) -> dict:
     """Highlight a country on the map"""
-    country_index = [i for i, c in enumerate(fig.data[0]["locations"]) if c == country][0]
-    highlighted_country = go.Choropleth(
-        locations=[country], z=[fig.data[0]["z"][country_index]],
-        locationmode="country names", text="Highlight",
-        hoverlabel={"bgcolor": styles.default.background_color},
-        hovertext=[int(fig.data[0]["hovertext"][country_index])],
-        marker_line_color=styles.highlight.map_outline_color,
-        colorscale=[styles.highlight.color, styles.highlight.color],
-        showscale=False, hovertemplate=map_hover_template)
-    fig.add_trace(highlighted_country)
-    return fig
-
-
-def highlight_bars(fig: go.Figure, country: str) -> go.Figure:
+    if highlighted_country := map_overlay(fig, country):
+        return {**fig.base, "data": [fig.base["data"][0], highlighted_country]}
+    return fig.base
+
+
+@instrumented
+def highlight_bars(fig: FigureInstance, country: str) -> dict:
     """Highlight an individual bar"""
-    bar_countries = fig.data[0].x
-    cols = [styles.default.color] * len(bar_countries)
-    country_position = [index for index, bar_country in enumerate(bar_countries)
-                        if bar_country == country]
-    for highlight_country in country_position:
-        cols[highlight_country] = styles.highlight.color
-        fig.data[0].marker.color = cols
-        return fig
+    if cols := bar_colors(fig, country):
+        return overlay_trace(fig.base, 0, {"marker": {"color": cols}})
+    return fig.base
+
+
+@instrumented
+def highlight_merged(fig: FigureInstance, country: str) -> dict:
+    """Highlight a country of merged lines by drawing its line on top"""
+    if highlighted_line := merged_overlay(fig, country):
+        return {**fig.base, "data": [*fig.base["data"], highlighted_line]}
+    return fig.base
+
+
+@instrumented
+def patch_lines(fig: FigureInstance,
+                previous: Optional[str],
+                country: Optional[str]) -> Patch:
+    """Restyle only the previously and the newly highlighted lines"""
+    patch = Patch()
+    for name, highlighted in [(previous, False), (country, True)]:
+        if (index := fig.position(name)) is not None:
+            for key, value in line_style(highlighted).items():
+                patch["data"][index][key] = value
+    return patch
+
 
+@instrumented
+def patch_bars(fig: FigureInstance,
+               previous: Optional[str],
+               country: Optional[str]) -> Patch:
+    """Recolor the bars"""
+    patch = Patch()
+    patch["data"][0]["marker"]["color"] = bar_colors(fig, country) or styles.default.color
+    return patch
 
+
+@instrumented
+def patch_map(fig: FigureInstance,
+              previous: Optional[str],
+              country: Optional[str]) -> Patch:
+    """Remove the previous highlight overlay from the map and add the new one"""
+    patch = Patch()
+    if map_overlay(fig, previous) is not None:
+        del patch["data"][1]
+    if (highlighted_country := map_overlay(fig, country)) is not None:
+        patch["data"].append(highlighted_country)
+    return patch
+
+
+@instrumented
+def patch_merged(fig: FigureInstance,
+                 previous: Optional[str],
+                 country: Optional[str]) -> Patch:
+    """Remove the previous highlight line from merged lines and add the new one"""
+    patch = Patch()
+    if fig.position(previous) is not None:
+        del patch["data"][fig.client_index["traces"]]
+    if (highlighted_line := merged_overlay(fig, country)) is not None:
+        patch["data"].append(highlighted_line)
+    return patch
+
+
+def index_lines(fig: go.Figure) -> dict:
+    """Compact description of a line plot for clientside highlighting"""
+    return {"type": "lines", "names": [trace.name for trace in fig.data]}
+
+
+def index_merged(fig: go.Figure) -> dict:
+    """
+    Compact description of merged lines for clientside highlighting: the point range
+    of every country's line (up to the gap that ends it), its hover details if any,
+    and the number of traces
+    """
+    lines = fig.data[0]
+    customdata = lines.customdata if lines.customdata is not None else []
+    names = np.asarray(customdata, dtype=object)
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]])[:names.size]
+    stops = np.r_[starts[1:], names.size][:starts.size] - 1
+    meta = lines.meta or {}
+    index = {"type": "merged",
+             "names": names[starts].tolist(),
+             "segments": np.c_[starts, stops].tolist(),
+             "traces": len(fig.data),
+             "overlay": merged_overlay_style(meta.get("hovertemplate")
+                                             or lines.hovertemplate)}
+    if "details" in meta:
+        index["details"] = list(meta["details"])
+    return index
+
+
+def index_bars(fig: go.Figure) -> dict:
+    """Compact description of a bar plot for clientside highlighting"""
+    return {"type": "bars", "names": list(fig.data[0].x)}
+
+
+def index_map(fig: go.Figure) -> dict:
+    """Compact description of the map for clientside highlighting"""
+    translator = get_country_translator()
+    locations = list(fig.data[0].locations)
+    return {"type": "map",
+            "names": locations,
+            "aliases": {alias: country for country in locations
+                        for alias in translator.aliases.get(country, [])},
+            "originals": {country: translator.original(country) for country in locations
+                          if translator.original(country) != country},
+            "z": [float(z) for z in fig.data[0].z],
+            "hovertext": [number(h) for h in fig.data[0].hovertext],
+            "overlay": map_overlay_style(fig.data[0].hovertemplate)}
+
+
+def client_highlight_index(instances: List[FigureInstance], token: str) -> dict:
+    """
+    Everything the browser needs to highlight countries without calling back the server
+    :param instances: figures as rendered on the page
+    :param token: identifies the figures (metric and snapshot) the index belongs to
+    :return: index by figure id along with styles and excluded traces
+    """
+    return {
+        "token": token,
+        "exclude": config["exclude"]["trace"],
+        "styles": {"default": line_style(highlighted=False),
+                   "highlight": line_style(highlighted=True)},
+        "figures": {instance.id_str: instance.client_index for instance in instances},
+    }
+
+
+@instrumented
 def find_selected_country(hover_context: List[Tuple[FigureInstance, HoverData]]) -> str:
     """find country that is being hovered over"""
     for fig, hover in hover_context:
@@ -78,10 +249,43 @@ def find_selected_country(hover_context: List[Tuple[FigureInstance, HoverData]])
             if fig.id_str in ["infected_countries"]:
                 return hover_data["x"]
             elif fig.id_str in ["infection_map"]:
-                return hover_data["location"]
+                return get_country_translator().original(hover_data["location"])
             else:
-                country = [content["name"]
-                           for index, content in enumerate(fig.figure.data)
-                           if index == hover_data["curveNumber"]][0]
-                if country not in config["exclude"]["trace"]:
+                if fig.client_index["type"] == "merged":
+                    country = hover_data.get("customdata")
+                else:
+                    country = fig.name_at(hover_data["curveNumber"])
+                if country is not None and country not in config["exclude"]["trace"]:
                     return country
+
+
+def plot_actions(instances: List[FigureInstance],
+                 hovers: List[HoverData],
+                 metric: str,
+                 snapshot_id: str,
+                 highlight_state: dict,
+                 switched: bool = False) -> list:
+    """
+    Outputs of the server-side highlight callback. Hover events only send patches that
+    restyle the previously and the newly highlighted country; full figures are only sent
+    when the metric changes or the client's figures come from an older snapshot
+    :param instances: figures of the selected metric, in the order of the hover data
+    :param hovers: hover data of every figure
+    :param metric: selected metric
+    :param snapshot_id: identifies the snapshot the figures belong to
+    :param highlight_state: what the client currently shows
+    :param switched: the metric selector triggered the callback
+    :return: a figure or patch per instance, followed by the new highlight state
+    :raise PreventUpdate: if the highlighted country did not change
+    """
+    hover_context = list(zip(instances, hovers))
+    country = None
+    if any(hovers):
+        country = find_selected_country(hover_context)
+    state = {"metric": metric, "country": country, "snapshot": snapshot_id}
+    if switched or {**highlight_state, "country": country} != state:
+        return [fig.render(country) for fig in instances] + [state]
+    if country == highlight_state["country"]:
+        raise PreventUpdate
+    previous = highlight_state["country"]
+    return [fig.restyle(previous, country) for fig in instances] + [state]
@@ -1,31 +1,109 @@
 """Extract data for the dashboard"""
 
+import hashlib
 import json
 import logging
+import time
+from dataclasses import dataclass, field
 from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import requests
-from cachetools.func import ttl_cache
 
-from covid19.types import Infections, InfectionStatus
-from covid19.utils import read_config, to_date
+from covid19.types import (Derivation, DerivedStatus, Infections, InfectionStatus, Metric,
+                           METRICS)
+from covid19.utils import atomic_write, population_index, to_date
 
 logger = logging.getLogger(__name__)
 
 
-@ttl_cache(maxsize=None, ttl=24*60*60)
-def get_infection_data() -> Infections:
+session = requests.Session()
+
+
+CHUNK_SIZE = 1 << 20
+
+
+@dataclass
+class Payload:
     """
-    Retrieve infections (confirmed cases, deaths and recoveries) by country and date.
-    Data is cached for 24 hours
-    :return: A dictionary of countries with a list of dates and counts
+    Raw response body, kept on disk; modified is False when a cached copy was served
+    instead of a fresh one
     """
-    config = read_config()
-    endpoint = config["endpoints"]["infections"]
-    text = requests.get(endpoint).text
-    infection_data = json.loads(text)
-    logger.info(f"retrieved infection data with {len(infection_data)} countries")
-    return infection_data
+    path: Path
+    modified: bool
+
+    @property
+    def body(self) -> bytes:
+        """The whole body"""
+        return self.path.read_bytes()
+
+    def fingerprint(self) -> dict:
+        """Identifies this version of the body (replaced, never modified in place)"""
+        stat = self.path.stat()
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def chunks(self, size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """Read the body incrementally"""
+        with open(str(self.path), "rb") as body:
+            while chunk := body.read(size):
+                yield chunk
+
+
+def cache_paths(endpoint: str, cache_dir: Path) -> Tuple[Path, Path]:
+    """Files holding the cached body of an endpoint and its validators"""
+    key = hashlib.sha1(endpoint.encode()).hexdigest()[:16]
+    return cache_dir / f"{key}.body", cache_dir / f"{key}.json"
+
+
+def fetch_payload(endpoint: str,
+                  cache_dir: Path,
+                  timeout: float = 30,
+                  http: requests.Session = session,
+                  max_age: float = 0) -> Payload:
+    """
+    Fetch an endpoint with a conditional request, keeping the last body and its validators
+    (ETag, Last-Modified) on disk. The body is streamed to the cache rather than held in
+    memory. A 304 response is served from the cache, and so is any connection or server
+    error as long as a cached copy exists
+    :param endpoint: URL to fetch
+    :param cache_dir: directory for the cached body and headers
+    :param timeout: connect and read timeout in seconds
+    :param http: session to send the request with
+    :param max_age: seconds during which a cached body is served without sending a request
+    :return: payload
+    """
+    body_path, meta_path = cache_paths(endpoint, cache_dir)
+    cached = body_path.exists() and meta_path.exists()
+    if cached and time.time() - body_path.stat().st_mtime < max_age:
+        return Payload(path=body_path, modified=False)
+    headers = {}
+    if cached:
+        meta = json.loads(meta_path.read_text())
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        with http.get(endpoint, headers=headers, timeout=timeout,
+                      stream=True) as response:
+            if response.status_code == 304 and cached:
+                logger.info(f"{endpoint} has not been modified, using the cached copy")
+                return Payload(path=body_path, modified=False)
+            response.raise_for_status()
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            atomic_write(body_path, response.iter_content(CHUNK_SIZE))
+    except requests.RequestException as error:
+        if not cached:
+            raise
+        logger.warning(f"failed to fetch {endpoint} ({error}), using the cached copy")
+        return Payload(path=body_path, modified=False)
+    atomic_write(meta_path, json.dumps({
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }).encode())
+    return Payload(path=body_path, modified=True)
 
 
 def filter_infection_data(
@@ -49,3 +127,443 @@ def filter_infection_data(
         for country, content in infection_data.items()}
     return {country: content for country, content
             in filtered_countries.items() if content}
+
+
+def shift(values: np.ndarray, periods: int) -> np.ndarray:
+    """Move the columns of a matrix right by the given number of periods, zero-filled"""
+    padded = np.pad(values, ((0, 0), (periods, 0)))
+    return padded[:, :values.shape[1]]
+
+
+def carry_forward(values: np.ndarray, observed: np.ndarray) -> np.ndarray:
+    """Fill unobserved cells of a matrix with the last observed value in the row (or 0)"""
+    columns = np.arange(values.shape[1])
+    last_seen = np.maximum.accumulate(np.where(observed, columns, -1), axis=1)
+    return np.where(last_seen >= 0,
+                    np.take_along_axis(values, np.maximum(last_seen, 0), axis=1), 0)
+
+
+SERIES = (Derivation.DAILY, Derivation.AVERAGE, Derivation.WEEKLY_CHANGE)
+"""Derivations computed by derive_series"""
+
+
+def derive_series(cumulative: np.ndarray,
+                  window: int = 7) -> Dict[Derivation, np.ndarray]:
+    """
+    Daily, moving-average and week-over-week series of cumulative counts, computed for all
+    rows at once by differencing
+    :param cumulative: cumulative count matrix on consecutive dates, with no gaps
+    :param window: number of days in the moving average and in a "week"
+    :return: derived count matrices by derivation
+    """
+    weekly = cumulative - shift(cumulative, window)
+    previous_weekly = shift(weekly, window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change = np.where(previous_weekly > 0, weekly / previous_weekly - 1, np.nan)
+    return {
+        Derivation.DAILY: cumulative - shift(cumulative, 1),
+        Derivation.AVERAGE: weekly / window,
+        Derivation.WEEKLY_CHANGE: change,
+    }
+
+
+def per_capita(counts: np.ndarray,
+               population: np.ndarray,
+               scale: float = 100_000) -> np.ndarray:
+    """
+    Counts per scale people
+    :param counts: count matrix with one row per country
+    :param population: population of every country, NaN where it is unknown
+    :return: normalized matrix, with NaN rows for countries of unknown population
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return counts * (scale / population)[:, None]
+
+
+def ratio(counts: np.ndarray, cases: np.ndarray) -> np.ndarray:
+    """Ratio of two count matrices (e.g. deaths per confirmed case), NaN without cases"""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(cases > 0, counts / cases, np.nan)
+
+
+@dataclass
+class ThresholdIndex:
+    """
+    Running maxima of a count matrix over observed days, laid out as one increasing
+    array (each row is offset by stride), so that the day every country first reaches a
+    threshold is found with a single binary search rather than by comparing every cell
+    """
+    running_max: np.ndarray
+    width: int
+    stride: int
+    floor: int
+    monotone: np.ndarray
+    last_observed: np.ndarray
+
+    @classmethod
+    def build(cls, counts: np.ndarray, observed: np.ndarray) -> "ThresholdIndex":
+        """
+        :param counts: count matrix (countries x dates)
+        :param observed: mask of observed cells
+        :return: threshold index of the matrix
+        """
+        floor = min(int(counts.min(initial=0)), 0) - 1
+        values = np.where(observed, counts, floor)
+        running_max = np.maximum.accumulate(values, axis=1) - floor
+        stride = int(running_max.max(initial=0)) + 1
+        columns = np.arange(counts.shape[1])
+        offsets = stride * np.arange(len(counts))[:, None]
+        return cls(running_max=(running_max + offsets).ravel(),
+                   width=counts.shape[1],
+                   stride=stride,
+                   floor=floor,
+                   monotone=((values - floor == running_max) | ~observed).all(axis=1),
+                   last_observed=np.where(observed, columns, -1).max(axis=1, initial=-1))
+
+    def crossing(self, min_cases: int) -> np.ndarray:
+        """
+        First date column at which every country has reached min_cases
+        :param min_cases: threshold
+        :return: column per country, the number of columns for countries that never reach
+        it
+        """
+        rows = np.arange(len(self.monotone))
+        target = min(max(min_cases - self.floor, 0), self.stride)
+        found = np.searchsorted(self.running_max, rows * self.stride + target)
+        return np.minimum(found - rows * self.width, self.width)
+
+
+@dataclass
+class RankingIndex:
+    """
+    Countries ranked by a metric on every date, each by the value of its latest
+    observation up to that date (in descending order of value, ties in country order). The
+    top N countries of any date are a slice of its column
+    """
+    order: np.ndarray
+    values: np.ndarray
+    ranked: np.ndarray
+
+    @classmethod
+    def build(cls, counts: np.ndarray, observed: np.ndarray) -> "RankingIndex":
+        """
+        :param counts: count matrix (countries x dates)
+        :param observed: mask of observed cells
+        :return: ranking index of the matrix; countries without an observation (or with
+        a NaN value) by a date are not ranked on it
+        """
+        columns = np.arange(counts.shape[1])
+        last_seen = np.maximum.accumulate(np.where(observed, columns, -1), axis=1)
+        values = np.take_along_axis(counts, np.maximum(last_seen, 0), axis=1)
+        ranked = (last_seen >= 0) & np.isfinite(values)
+        key = np.where(ranked, -values.astype(float), np.inf)
+        return cls(order=np.argsort(key, axis=0, kind="stable"),
+                   values=values,
+                   ranked=ranked.sum(axis=0))
+
+    def top(self, n: int, column: int = -1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top ranked countries of a date
+        :param n: max. number of countries
+        :param column: date column
+        :return: a tuple of country rows and their values, in descending order of value
+        """
+        if not self.ranked.size:
+            return np.empty(0, dtype=int), np.empty(0, dtype=self.values.dtype)
+        rows = self.order[:min(n, int(self.ranked[column])), column]
+        return rows, self.values[rows, column]
+
+
+@dataclass
+class StoreDelta:
+    """Countries whose records changed between two versions of the raw data"""
+    countries: List[str]
+    removed: List[str]
+
+    @property
+    def empty(self) -> bool:
+        return not (self.countries or self.removed)
+
+
+@dataclass(eq=False)
+class InfectionStore:
+    """
+    Columnar infection data: one dense countries x dates count matrix per infection status
+    on a shared datetime64 date axis. Cells that are absent from the source (or that were
+    removed by a filter) are flagged as unobserved rather than dropped. Derived series,
+    once added by derive, are held alongside the counts (and their global totals by date)
+    """
+
+    countries: List[str]
+    dates: np.ndarray
+    counts: Dict[Metric, np.ndarray]
+    observed: np.ndarray
+    totals: Dict[Metric, np.ndarray] = field(default_factory=dict)
+    index: Dict[str, int] = field(init=False, repr=False)
+    thresholds: Dict[InfectionStatus, ThresholdIndex] = field(init=False, repr=False)
+    rankings: Dict[Metric, RankingIndex] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.index = {country: row for row, country in enumerate(self.countries)}
+        self.thresholds = {}
+        self.rankings = {}
+
+    @classmethod
+    def from_infections(cls, infection_data: Infections) -> "InfectionStore":
+        """
+        Build a store from the dictionary-of-records format returned by the endpoint
+        :param infection_data: a dictionary of countries with a list of dates and counts
+        :return: infection store
+        """
+        countries = list(infection_data.keys())
+        records = [day for content in infection_data.values() for day in content]
+        parsed_dates = {
+            date_str: to_date(date_str) for date_str in {r["date"] for r in records}
+        }
+        dates = np.array(sorted(set(parsed_dates.values())), dtype="datetime64[D]")
+        columns = {date_str: int(np.searchsorted(dates, np.datetime64(date, "D")))
+                   for date_str, date in parsed_dates.items()}
+        kinds = [
+            kind for kind in InfectionStatus if any(kind.value in r for r in records)
+        ]
+        shape = (len(countries), len(dates))
+        observed = np.zeros(shape, dtype=bool)
+        counts = {kind: np.zeros(shape, dtype=np.int64) for kind in kinds}
+        for row, content in enumerate(infection_data.values()):
+            if not content:
+                continue
+            cols = [columns[day["date"]] for day in content]
+            observed[row, cols] = True
+            for kind in kinds:
+                counts[kind][row, cols] = [day.get(kind.value) or 0 for day in content]
+        return cls(countries=countries, dates=dates, counts=counts, observed=observed)
+
+    @classmethod
+    def combine(cls, stores: List["InfectionStore"]) -> "InfectionStore":
+        """
+        Combine the raw stores of several sources into one, e.g. national and sub-national
+        series. Countries keep the order in which they first appear; a country present in
+        several stores takes the rows of the last one
+        :param stores: raw stores (a single store is returned as it is)
+        :return: infection store on the union of the dates
+        """
+        if len(stores) == 1:
+            return stores[0]
+        latest = {country: (store, row) for store in stores
+                  for row, country in enumerate(store.countries)}
+        countries = list(latest)
+        dates = np.unique(np.concatenate([np.empty(0, dtype="datetime64[D]")] +
+                                         [store.dates for store in stores]))
+        kinds = [kind for kind in InfectionStatus
+                 if any(kind in store.counts for store in stores)]
+        shape = (len(countries), len(dates))
+        observed = np.zeros(shape, dtype=bool)
+        counts = {kind: np.zeros(shape, dtype=np.int64) for kind in kinds}
+        for store in stores:
+            rows = [row for row, country in enumerate(countries)
+                    if latest[country][0] is store]
+            source_rows = [latest[countries[row]][1] for row in rows]
+            cells = np.ix_(rows, np.searchsorted(dates, store.dates))
+            observed[cells] = store.observed[source_rows]
+            for kind, values in store.counts.items():
+                if isinstance(kind, InfectionStatus):
+                    counts[kind][cells] = values[source_rows]
+        return cls(countries=countries, dates=dates, counts=counts, observed=observed)
+
+    def diff(self, latest: "InfectionStore") -> StoreDelta:
+        """
+        Compare this store with one built from a newer version of the payload
+        :param latest: store of the newer version
+        :return: countries that are new or whose records changed, and countries that are
+        gone
+        """
+        dates = np.union1d(self.dates, latest.dates)
+        shared = [country for country in latest.countries if country in self.index]
+
+        def align(store: InfectionStore, values: Optional[np.ndarray]) -> np.ndarray:
+            rows = [store.index[country] for country in shared]
+            aligned = np.zeros((len(shared), len(dates)), dtype=np.int64)
+            if values is not None:
+                aligned[:, np.searchsorted(dates, store.dates)] = values[rows]
+            return aligned
+
+        changed = (align(self, self.observed)
+                   != align(latest, latest.observed)).any(axis=1)
+        for kind in InfectionStatus:
+            changed |= (align(self, self.counts.get(kind))
+                        != align(latest, latest.counts.get(kind))).any(axis=1)
+        changed_countries = {country for country, is_changed in zip(shared, changed)
+                             if is_changed}
+        return StoreDelta(countries=[country for country in latest.countries
+                                     if country in changed_countries
+                                     or country not in self.index],
+                          removed=[country for country in self.countries
+                                   if country not in latest.index])
+
+    def derive(self,
+               window: int = 7,
+               population: Optional[np.ndarray] = None,
+               metrics: Iterable[Metric] = METRICS) -> "InfectionStore":
+        """
+        Add the derived series of the given metrics, per country and globally: daily,
+        moving-average and week-over-week series of an infection status (unobserved days
+        carry the last count forward, so the increase over a gap is attributed to the day
+        it is reported), counts per 100k people and deaths per confirmed case. Derive
+        before filtering, so that the first days that pass a filter have a previous day to
+        compare to
+        :param window: number of days in the moving average and in a "week"
+        :param population: population of every country (NaN where unknown), joined from
+        the bundled population table if not given
+        :param metrics: metrics to derive, by default the selectable ones; the others are
+        not computed
+        :return: a store with the derived series (the counts are shared with this one,
+        unless they are narrower than int64, e.g. when loaded from an archive)
+        """
+        metrics = set(metrics)
+        counts = {kind: values.astype(np.int64, copy=False)
+                  if isinstance(kind, InfectionStatus) else values
+                  for kind, values in self.counts.items()}
+        totals = dict(self.totals)
+        if population is None:
+            population = population_index(self.countries)
+        known = np.isfinite(population)
+        for kind in [kind for kind in self.counts if isinstance(kind, InfectionStatus)]:
+            carried = carry_forward(self.counts[kind], self.observed)
+            totals[kind] = carried.sum(axis=0)
+            if any(DerivedStatus(kind, derivation) in metrics for derivation in SERIES):
+                for derivation, values in derive_series(carried, window).items():
+                    if DerivedStatus(kind, derivation) in metrics:
+                        counts[DerivedStatus(kind, derivation)] = values
+                total_series = derive_series(totals[kind][None], window)
+                for derivation, values in total_series.items():
+                    if DerivedStatus(kind, derivation) in metrics:
+                        totals[DerivedStatus(kind, derivation)] = values[0]
+            per_100k = DerivedStatus(kind, Derivation.PER_100K)
+            if per_100k in metrics:
+                counts[per_100k] = per_capita(counts[kind], population)
+                totals[per_100k] = per_capita(carried[known].sum(axis=0)[None],
+                                              population[known].sum(keepdims=True))[0]
+        per_case = DerivedStatus(InfectionStatus.DEATHS, Derivation.PER_CASE)
+        if (per_case in metrics and InfectionStatus.CONFIRMED in self.counts
+                and InfectionStatus.DEATHS in self.counts):
+            counts[per_case] = ratio(counts[InfectionStatus.DEATHS],
+                                     counts[InfectionStatus.CONFIRMED])
+            totals[per_case] = ratio(totals[InfectionStatus.DEATHS],
+                                     totals[InfectionStatus.CONFIRMED])
+        return InfectionStore(countries=self.countries, dates=self.dates, counts=counts,
+                              observed=self.observed, totals=totals)
+
+    def threshold_index(self, kind: InfectionStatus) -> ThresholdIndex:
+        """Threshold index of an infection status, built on first use"""
+        if kind not in self.thresholds:
+            self.thresholds[kind] = ThresholdIndex.build(self.counts[kind], self.observed)
+        return self.thresholds[kind]
+
+    def ranking(self, kind: Metric) -> RankingIndex:
+        """Ranking index of a metric, built on first use"""
+        if kind not in self.rankings:
+            self.rankings[kind] = RankingIndex.build(self.counts[kind], self.observed)
+        return self.rankings[kind]
+
+    def filter(self,
+               kind: InfectionStatus = InfectionStatus.CONFIRMED,
+               min_cases: int = 100,
+               min_date: datetime = datetime(2020, 1, 1)) -> "InfectionStore":
+        """
+        Vectorized equivalent of filter_infection_data. The days kept for a country start
+        at min_date or at the day it crosses min_cases, whichever is later, both located
+        with a binary search; only countries whose counts ever decrease are compared cell
+        by cell
+        :param kind: either confirmed or deaths
+        :param min_cases: min. number of cases for a day to be kept
+        :param min_date: first date to be included into the data
+        :return: a store restricted to the matching days and to countries with at least
+        one of them (global totals are restricted to the matching dates only)
+        """
+        thresholds = self.threshold_index(kind)
+        start = int(np.searchsorted(self.dates, np.datetime64(min_date, "D")))
+        first = np.maximum(thresholds.crossing(min_cases), start)
+        rows = np.flatnonzero(first <= thresholds.last_observed)
+        observed = self.observed[rows, start:] & (
+            np.arange(start, len(self.dates)) >= first[rows, None])
+        irregular = ~thresholds.monotone[rows]
+        if irregular.any():
+            observed[irregular] &= self.counts[kind][rows[irregular], start:] >= min_cases
+            kept = observed.any(axis=1)
+            rows, observed = rows[kept], observed[kept]
+        # when every country is kept the counts are sliced as views rather than copied
+        selected = slice(None) if len(rows) == len(self.countries) else rows
+        return InfectionStore(
+            countries=[self.countries[row] for row in rows],
+            dates=self.dates[start:],
+            counts={k: v[selected, start:] for k, v in self.counts.items()},
+            observed=observed,
+            totals={k: v[start:] for k, v in self.totals.items()})
+
+    def lag_index(self, lag: int = 1) -> np.ndarray:
+        """
+        Locate the lag-th most recent observed day of every country
+        :param lag: how many days back from the most recent observation to go
+        (1 is latest)
+        :return: date column per country, -1 for countries with fewer than lag
+        observations
+        """
+        n_observed = self.observed.sum(axis=1)
+        rank = np.cumsum(self.observed, axis=1)
+        target = (n_observed - lag + 1)[:, None]
+        hits = self.observed & (rank == target)
+        return np.where(n_observed >= lag, hits.argmax(axis=1), -1)
+
+    def latest(self, kind: Metric, lag: int = 1) -> np.ndarray:
+        """
+        Counts on the lag-th most recent observed day of every country
+        :param kind: infection status or derived series
+        :param lag: how many days back from the most recent observation to go
+        (1 is latest)
+        :return: count per country, 0 for countries with fewer than lag observations
+        """
+        columns = self.lag_index(lag)
+        values = self.counts[kind][np.arange(len(self.countries)), columns]
+        return np.where(columns >= 0, values, 0)
+
+    def last_update(self) -> datetime:
+        """Most recent date with at least one observation"""
+        observed_dates = self.dates[self.observed.any(axis=0)]
+        return observed_dates.max().astype("datetime64[s]").astype(datetime)
+
+    def series(self, country: str, kind: Metric) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Observed dates and counts of a single country
+        :param country: country name
+        :param kind: infection status or derived series
+        :return: a tuple of dates and counts
+        """
+        row = self.index[country]
+        mask = self.observed[row]
+        return self.dates[mask], self.counts[kind][row, mask]
+
+    def aligned(self, kind: InfectionStatus) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Shift every country's observed counts to the left, so that column i holds
+        the i-th observed day of that country (days since entering the dataset)
+        :param kind: either confirmed or deaths
+        :return: a tuple of a count matrix and a mask of valid cells
+        """
+        order = np.argsort(~self.observed, axis=1, kind="stable")
+        values = np.take_along_axis(self.counts[kind], order, axis=1)
+        valid = np.take_along_axis(self.observed, order, axis=1)
+        return values, valid
+
+    def to_infections(self) -> Infections:
+        """
+        Compatibility view in the dictionary-of-records format
+        (dates are rendered as Y-m-d)
+        :return: a dictionary of countries with a list of dates and counts
+        """
+        date_strs = np.datetime_as_string(self.dates, unit="D")
+        return {country: [{"date": str(date_strs[col]),
+                           **{kind.value: int(values[row, col])
+                              for kind, values in self.counts.items()
+                              if isinstance(kind, InfectionStatus)}}
+                          for col in np.flatnonzero(self.observed[row])]
+                for row, country in enumerate(self.countries)}
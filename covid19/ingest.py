@@ -0,0 +1,190 @@
+"""
+Streaming ingest of the timeseries.json payload ({"country": [{"date": ...,
+"confirmed": ..., "deaths": ...}, ...], ...}). Only the unparsed tail of the input is
+buffered, and every country's records are scanned straight into arrays as soon as its
+list is complete, without creating an object per day. Smaller feeds in CSV (one row
+per country, or region, and date) are read with the csv module
+"""
+
+import codecs
+import csv
+import json
+import re
+from dataclasses import dataclass
+from itertools import chain
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from covid19.data import InfectionStore
+from covid19.types import InfectionStatus
+from covid19.utils import to_date
+
+COUNTRY = re.compile(rb'"((?:[^"\\]|\\.)*)"\s*:\s*\[')
+DATE = re.compile(rb'"date"\s*:\s*"(\d{4})-(\d{1,2})-(\d{1,2})"')
+COUNTS = {kind: re.compile(rb'"%s"\s*:\s*(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|null)'
+                           % kind.value.encode())
+          for kind in InfectionStatus}
+
+
+@dataclass
+class CountrySeries:
+    """Dates and counts of a single country, in the order of its records"""
+    dates: np.ndarray
+    counts: Dict[InfectionStatus, np.ndarray]
+
+
+def parse_dates(matches: List[Tuple[bytes, bytes, bytes]]) -> np.ndarray:
+    """Turn matched year, month and day strings into datetime64 dates"""
+    parts = np.fromiter(map(int, chain.from_iterable(matches)), np.int64,
+                        3 * len(matches)).reshape(-1, 3)
+    months = (parts[:, 0] - 1970).astype("datetime64[Y]").astype("datetime64[M]")
+    days = (months + (parts[:, 1] - 1).astype("timedelta64[M]")).astype("datetime64[D]")
+    return days + (parts[:, 2] - 1).astype("timedelta64[D]")
+
+
+def parse_counts(matches: List[bytes]) -> np.ndarray:
+    """Turn matched JSON numbers (or nulls, counted as zero) into integers"""
+    try:
+        return np.fromiter(map(int, matches), np.int64, len(matches))
+    except ValueError:
+        numbers = np.array(matches)
+        numbers = np.where(numbers == b"null", b"0", numbers)
+        return numbers.astype(np.float64).astype(np.int64)
+
+
+class TimeseriesParser:
+    """Incremental parser building an infection store from chunks of the payload"""
+
+    def __init__(self):
+        self.series: Dict[str, CountrySeries] = {}
+        self._buffer = bytearray()
+        self._opened = False
+        self._dates: Tuple[list, np.ndarray] = ([], np.empty(0, dtype="datetime64[D]"))
+
+    def feed(self, chunk: bytes):
+        """
+        Parse the countries whose list is complete, keeping the rest for later
+        :param chunk: next piece of the payload
+        :raise ValueError: if the payload does not start with a JSON object
+        """
+        self._buffer += chunk
+        if not self._opened:
+            start = len(self._buffer) - len(self._buffer.lstrip())
+            if start == len(self._buffer):
+                return
+            if self._buffer[start:start + 1] != b"{":
+                raise ValueError("infection payload is not a JSON object")
+            del self._buffer[:start + 1]
+            self._opened = True
+        position = 0
+        while (country := COUNTRY.search(self._buffer, position)) is not None:
+            end = self._buffer.find(b"]", country.end())
+            if end < 0:
+                break
+            name = json.loads(b'"' + country.group(1) + b'"')
+            self.series[name] = self.scan(bytes(self._buffer[country.end():end]))
+            position = end + 1
+        del self._buffer[:position]
+
+    def scan(self, records: bytes) -> CountrySeries:
+        """
+        Read the records of a country's list with regular expressions (countries usually
+        share their dates, so the dates of the previous country are reused when they
+        match). Lists without a date and the same counts in every record are parsed as
+        JSON instead
+        :param records: contents of the list, without the brackets
+        :return: dates and counts
+        """
+        size = records.count(b"{")
+        dates = DATE.findall(records)
+        counts = {kind: pattern.findall(records) for kind, pattern in COUNTS.items()}
+        if (len(dates) != size
+                or any(len(values) not in (0, size) for values in counts.values())):
+            content = json.loads(b"[" + records + b"]")
+            return CountrySeries(
+                dates=np.array([to_date(day["date"]) for day in content],
+                               dtype="datetime64[D]"),
+                counts={kind: np.array([day.get(kind.value) or 0 for day in content],
+                                       dtype=np.int64)
+                        for kind in InfectionStatus
+                        if any(kind.value in day for day in content)})
+        if dates != self._dates[0]:
+            self._dates = (dates, parse_dates(dates))
+        return CountrySeries(dates=self._dates[1],
+                             counts={kind: parse_counts(values)
+                                     for kind, values in counts.items() if values})
+
+    def close(self) -> InfectionStore:
+        """
+        Assemble the store once the whole payload has been fed
+        :return: infection store, as InfectionStore.from_infections would build it
+        :raise ValueError: if the payload is not a JSON object, ended before the object
+        was closed, holds anything but countries after the last one or no country at all
+        """
+        if not self._opened:
+            raise ValueError("infection payload is not a JSON object")
+        tail = bytes(self._buffer).strip(b" \t\r\n,")
+        if COUNTRY.search(tail) or not tail.endswith(b"}"):
+            raise ValueError("infection payload is truncated")
+        if tail != b"}":
+            raise ValueError(f"unexpected content in the infection payload: "
+                             f"{tail[:80].decode(errors='replace')}")
+        if not self.series:
+            raise ValueError("infection payload has no countries")
+        countries = list(self.series)
+        dates = np.unique(np.concatenate(
+            [np.empty(0, dtype="datetime64[D]")]
+            + [series.dates for series in self.series.values()]))
+        kinds = [kind for kind in InfectionStatus
+                 if any(kind in series.counts for series in self.series.values())]
+        shape = (len(countries), len(dates))
+        observed = np.zeros(shape, dtype=bool)
+        counts = {kind: np.zeros(shape, dtype=np.int64) for kind in kinds}
+        for row, series in enumerate(self.series.values()):
+            columns = np.searchsorted(dates, series.dates)
+            observed[row, columns] = True
+            for kind, values in series.counts.items():
+                counts[kind][row, columns] = values
+        return InfectionStore(countries=countries, dates=dates, counts=counts,
+                              observed=observed)
+
+
+def parse_infections(chunks: Iterable[bytes]) -> InfectionStore:
+    """
+    Build an infection store from the payload, read incrementally
+    :param chunks: the payload in pieces of any size
+    :return: infection store
+    """
+    parser = TimeseriesParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    return parser.close()
+
+
+def lines(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Decode chunks of UTF-8 text (with or without a byte order mark) into lines"""
+    pending = ""
+    for text in codecs.iterdecode(chunks, "utf-8-sig"):
+        *complete, pending = (pending + text).split("\n")
+        yield from complete
+    if pending:
+        yield pending
+
+
+def parse_csv_infections(chunks: Iterable[bytes]) -> InfectionStore:
+    """
+    Build an infection store from CSV with a header row, a country and a date (Y-m-d)
+    column, an optional region column and a column per infection status (empty cells
+    count as zero). Regions are named "country / region"
+    :param chunks: the payload in pieces of any size
+    :return: infection store
+    """
+    infection_data: Dict[str, List[dict]] = {}
+    for row in csv.DictReader(lines(chunks)):
+        name = (f"{row['country']} / {row['region']}" if row.get("region")
+                else row["country"])
+        infection_data.setdefault(name, []).append(
+            {"date": row["date"], **{kind.value: int(float(row[kind.value] or 0))
+                                     for kind in InfectionStatus if kind.value in row}})
+    return InfectionStore.from_infections(infection_data)
@@ -80,26 +80,54 @@ line_style_layout = {
 }
 
 
-bar_hover_template = (
-    f"<span style='color:{styles.default.background_color};" +
-    "font-size:20px'><b>%{x}</b></span><br><br>" +
-    "Cases: %{y}<br>" +
-    "<extra></extra>"
-)
+metric_labels = {
+    "confirmed": "Cases",
+    "deaths": "Deaths",
+    "confirmed_daily": "Daily cases",
+    "deaths_daily": "Daily deaths",
+    "confirmed_average": "Daily cases (weekly average)",
+    "deaths_average": "Daily deaths (weekly average)",
+    "confirmed_weekly_change": "Weekly change in cases",
+    "deaths_weekly_change": "Weekly change in deaths",
+    "confirmed_per_100k": "Cases per 100k",
+    "deaths_per_100k": "Deaths per 100k",
+    "deaths_per_case": "Deaths per case",
+}
+
+
+def bar_hover_template(label: str = "Cases") -> str:
+    """Generate text for the bars, labelling values with the metric's label"""
+    return (f"<span style='color:{styles.default.background_color};" +
+            "font-size:20px'><b>%{x}</b></span><br><br>" +
+            f"{label}: %{{y}}<br>" +
+            "<extra></extra>")
 
-map_hover_template = (
-    f"<span style='color:{styles.default.color};" +
-    "font-size:20px'><b>%{location}</b></span><br>" +
-    f"<span style='color:{styles.default.alternative_color}'>" +
-    "Cases: %{hovertext:,}</span>" +
-    "<extra></extra>"
-)
+
+def map_hover_template(label: str = "Cases") -> str:
+    """Generate text for the map, labelling values with the metric's label"""
+    return (f"<span style='color:{styles.default.color};" +
+            "font-size:20px'><b>%{location}</b></span><br>" +
+            f"<span style='color:{styles.default.alternative_color}'>" +
+            f"{label}: %{{hovertext:,}}</span>" +
+            "<extra></extra>")
 
 
-def trace_hover_template(country: str) -> str:
+def trace_hover_template(country: str, label: str = "Cases") -> str:
     """Generate text for a traces corresponding to specific countries"""
     return (f"<span style='color:{styles.default.background_color};" +
             f"font-size:20px'><b>{country}</b></span><br><br>" +
             "Date: %{x}<br>" +
-            "Cases: %{y:,}" +
+            f"{label}: %{{y:,}}" +
+            "<extra></extra>")
+
+
+def trend_hover_template(country: str,
+                         details: str = "%{meta}",
+                         label: str = "Cases") -> str:
+    """Generate text for a country's trend trace, with its growth (trace meta) below"""
+    return (f"<span style='color:{styles.default.background_color};" +
+            f"font-size:20px'><b>{country}</b></span><br><br>" +
+            "Day: %{x}<br>" +
+            f"{label}: %{{y:,}}<br>" +
+            details +
             "<extra></extra>")
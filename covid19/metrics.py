@@ -0,0 +1,169 @@
+"""
+In-process metrics of the request hot path (callback and highlight latencies, response
+sizes), exposed in the Prometheus text format. Every worker process keeps its own metrics
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from dash.exceptions import PreventUpdate
+
+from covid19.utils import read_config
+
+config = read_config()
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    """Prometheus-style histogram with fixed upper bounds, one series per label set"""
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...],
+                 labels: Tuple[str, ...]):
+        """
+        :param name: metric name
+        :param documentation: help text
+        :param buckets: upper bounds of the buckets, in increasing order
+        :param labels: label names
+        """
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.labels = labels
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str):
+        """Record a value"""
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            empty = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self._series.setdefault(key, empty)
+            counts[bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[Dict[str, str]]:
+        """
+        Observe the wall time of the enclosed block. The yielded labels may be
+        changed inside the block, e.g. once the outcome is known
+        """
+        start = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        """Lines of the metric in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: (list(counts), total[0])
+                      for key, (counts, total) in sorted(self._series.items())}
+        for key, (counts, total) in series.items():
+            labels = [f'{label}="{value}"' for label, value in zip(self.labels, key)]
+            cumulative = 0
+            for bound, count in zip([*map(str, self.buckets), "+Inf"], counts):
+                cumulative += count
+                bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{{{bucket_labels}}} {cumulative}")
+            label_str = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics: List[Histogram] = []
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+                  labels: Tuple[str, ...] = ()) -> Histogram:
+        """Create and register a histogram"""
+        histogram = Histogram(name, documentation, buckets, labels)
+        self.metrics.append(histogram)
+        return histogram
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+callback_seconds = registry.histogram(
+    "covid19_callback_seconds", "Latency of Dash callbacks",
+    labels=("callback", "trigger", "outcome"))
+function_seconds = registry.histogram(
+    "covid19_highlight_function_seconds",
+    "Latency of highlight, restyle and lookup functions",
+    labels=("function", "figure"))
+response_bytes = registry.histogram(
+    "covid19_callback_response_bytes", "Size of serialized callback responses",
+    buckets=SIZE_BUCKETS, labels=("trigger",))
+
+
+def instrumented(function: Callable) -> Callable:
+    """
+    Record the latency of a highlight function; the figure label is the id of the
+    figure instance passed first, if any
+    """
+    if not config["metrics"]["enabled"]:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        figure = getattr(args[0], "id_str", "all") if args else "all"
+        with function_seconds.time(function=function.__name__, figure=figure):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def instrumented_callback(trigger: Callable[[], str]) -> Callable[[Callable], Callable]:
+    """
+    Record the latency of a Dash callback by trigger and outcome (ok, prevented or error)
+    :param trigger: returns what triggered the current call
+    :return: decorator
+    """
+    def decorator(function: Callable) -> Callable:
+        if not config["metrics"]["enabled"]:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with callback_seconds.time(callback=function.__name__, trigger=trigger(),
+                                       outcome="error") as labels:
+                try:
+                    result = function(*args, **kwargs)
+                except PreventUpdate:
+                    labels["outcome"] = "prevented"
+                    raise
+                labels["outcome"] = "ok"
+                return result
+
+        return wrapper
+
+    return decorator
+
+
+def record_response(payload: dict, size: int):
+    """
+    Record the size of a callback response
+    :param payload: JSON body of the callback request
+    :param size: response size in bytes
+    """
+    changed = (payload or {}).get("changedPropIds") or ["initial"]
+    response_bytes.observe(size, trigger=changed[0].split(".")[0])
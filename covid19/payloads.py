@@ -0,0 +1,113 @@
+"""
+Pre-serialized responses. Payloads that only change with the snapshot (e.g. the page
+layout) are serialized and compressed once and served as bytes with strong ETags
+"""
+
+import gzip
+import hashlib
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable
+
+from cachetools import LRUCache
+from flask import Request, Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {
+    "gzip": lambda body: gzip.compress(body, compresslevel=9, mtime=0),
+}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=11)
+
+
+def placeholder(name: str) -> str:
+    """Value standing in for a pre-serialized JSON value until it is spliced in"""
+    return f"__payload_{name}__"
+
+
+def splice_json(body: str, values: Dict[str, bytes]) -> bytes:
+    """
+    Replace placeholders in a JSON document with pre-serialized JSON values
+    :param body: JSON document containing placeholder strings
+    :param values: serialized values by placeholder name
+    :return: the complete JSON document
+    """
+    encoded = body.encode()
+    for name, value in values.items():
+        encoded = encoded.replace(f'"{placeholder(name)}"'.encode(), value, 1)
+    return encoded
+
+
+@dataclass(frozen=True)
+class EncodedPayload:
+    """A response body in every available content coding, with an ETag per coding"""
+    mimetype: str
+    bodies: Dict[str, bytes]
+    etags: Dict[str, str]
+
+    @classmethod
+    def encode(cls,
+               body: bytes,
+               encodings: Iterable[str],
+               mimetype: str = "application/json") -> "EncodedPayload":
+        """
+        Compress a body once in each of the given codings (unavailable ones are skipped)
+        :param body: uncompressed body
+        :param encodings: content codings, e.g. br and gzip
+        :param mimetype: media type of the body
+        :return: encoded payload
+        """
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        bodies = {"identity": body}
+        for encoding in encodings:
+            if encoding in COMPRESSORS:
+                bodies[encoding] = COMPRESSORS[encoding](body)
+        etags = {encoding: digest if encoding == "identity" else f"{digest}-{encoding}"
+                 for encoding in bodies}
+        return cls(mimetype, bodies, etags)
+
+    def response(self, request: Request) -> Response:
+        """
+        Response in the coding the client prefers, or 304 if it already has that version
+        :param request: request being answered
+        :return: response
+        """
+        encoding = request.accept_encodings.best_match(list(self.bodies), "identity")
+        response = Response(self.bodies[encoding], mimetype=self.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = "no-cache"
+        response.set_etag(self.etags[encoding])
+        return response.make_conditional(request)
+
+
+class PayloadCache:
+    """
+    Encoded payloads by key (e.g. snapshot), built on first request. Only the maxsize most
+    recently used keys are held, so payloads of replaced snapshots are dropped
+    """
+
+    def __init__(self, build: Callable[[Hashable], bytes], encodings: Iterable[str],
+                 maxsize: int = 2):
+        """
+        :param build: serializes the payload of a key
+        :param encodings: content codings to precompress payloads in
+        :param maxsize: max. number of payloads held at a time
+        """
+        self.encodings = list(encodings)
+        self._build = build
+        self._lock = threading.Lock()
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def __getitem__(self, key: Hashable) -> EncodedPayload:
+        with self._lock:
+            payload = self._cache.get(key)
+            if payload is None:
+                payload = self._cache[key] = EncodedPayload.encode(self._build(key),
+                                                                   self.encodings)
+            return payload
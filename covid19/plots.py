@@ -1,124 +1,345 @@
 """Visualizations of infection data. Note that plot types are found here to avoid circular imports"""
 
+import threading
+from collections.abc import Mapping
 from dataclasses import dataclass
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import numpy as np
 import plotly.graph_objects as go
+from cachetools import LRUCache
 
 from covid19 import callbacks as cb
 from covid19 import layout
-from covid19.data import filter_infection_data
-from covid19.stats import fit_infection_trend
-from covid19.types import Infections, InfectionStatus, FigureInstance
-from covid19.utils import to_date, translate_countries, read_config
+from covid19.data import InfectionStore, StoreDelta
+from covid19.profiling import profiler
+from covid19.stats import (build_growth_models, fit_growth_models, fit_infection_trend,
+                           GrowthModels)
+from covid19.types import (base_status, Derivation, FigureInstance, InfectionStatus,
+                           Metric, METRICS, parse_metric)
+from covid19.utils import get_country_translator, population_index, read_config
 
 config = read_config()
 
+Coordinates = Tuple[np.ndarray, np.ndarray]
+
+MERGED_LINES = "Countries"
+
+
+def infection_curve_trace(country: str,
+                          dates: np.ndarray,
+                          counts: np.ndarray,
+                          label: str = "Cases") -> go.Scatter:
+    """Style the infection curve of a single country"""
+    return go.Scatter(x=dates, y=counts, opacity=0.25,
+                      name=country, mode="lines", showlegend=False,
+                      legendgroup=country, line=layout.line_style_layout,
+                      hovertemplate=layout.trace_hover_template(country, label))
+
+
+def infection_trend_trace(country: str,
+                          days: np.ndarray,
+                          counts: np.ndarray,
+                          label: str = "Cases") -> go.Scatter:
+    """Style the days-since-threshold line of a single country"""
+    return go.Scatter(x=days, y=counts, name=country, opacity=0.25,
+                      mode="lines", line=layout.line_style_layout, showlegend=False,
+                      hovertemplate=layout.trend_hover_template(country, label=label))
+
+
+def merged_lines_trace(coordinates: Dict[str, Coordinates],
+                       hovertemplate: str,
+                       details: Optional[Dict[str, str]] = None,
+                       details_template: Optional[str] = None) -> go.Scattergl:
+    """
+    Pack the lines of many countries into a single WebGL trace. Lines are separated by
+    gaps (a NaN count) and every point carries its country as customdata. Hover details,
+    which would be repeated for every point, are kept once per country in the trace meta
+    and are only shown on the line of the highlighted country
+    :param coordinates: x and y values by country
+    :param hovertemplate: hover text, referring to the country as %{customdata}
+    :param details: hover details by country
+    :param details_template: hover text of a highlighted line, referring to its details
+    as %{meta}
+    :return: a trace with the lines of all countries
+    """
+    lengths = [counts.size + 1 for _, counts in coordinates.values()]
+    xs = [part for x, _ in coordinates.values() for part in (x, x[-1:])]
+    ys = [part for _, y in coordinates.values() for part in (y.astype(float), [np.nan])]
+    meta = None
+    if details is not None:
+        meta = {"details": [details.get(country, "") for country in coordinates],
+                "hovertemplate": details_template}
+    countries = np.array(list(coordinates), dtype=object)
+    return go.Scattergl(x=np.concatenate(xs) if xs else [],
+                        y=np.concatenate(ys) if ys else [],
+                        customdata=np.repeat(countries, lengths),
+                        name=MERGED_LINES, meta=meta, mode="lines",
+                        opacity=layout.styles.default.opacity,
+                        line=layout.line_style_layout,
+                        connectgaps=False, showlegend=False, hovertemplate=hovertemplate)
+
+
+def trend_line_trace(filtered_store: InfectionStore, kind: Metric) -> go.Scatter:
+    """Fit the global trend and draw it as a line"""
+    global_days, trend = fit_infection_trend(kind, filtered_store)
+    return go.Scatter(x=global_days, y=trend, name="Trend", mode="lines",
+                      line={"color": layout.styles.default.alternative_color, "width": 3},
+                      showlegend=False,
+                      hovertemplate=layout.trace_hover_template(
+                          "Trend", layout.metric_labels[kind.value]))
+
+
+def annotate_growth(figure: go.Figure, growth: GrowthModels, countries: Iterable[str]):
+    """Attach the growth description of the given countries to their traces (in place)"""
+    positions = {trace.name: index for index, trace in enumerate(figure.data)}
+    with figure.batch_update():
+        for country in countries:
+            if country in positions:
+                figure.data[positions[country]].meta = growth.describe(country)
+
+
+def trend_layout(filtered_store: InfectionStore, min_cases: int) -> dict:
+    """Layout of the trend plot; the anchor country sets the number of days shown"""
+    anchor_country = str(config["anchor"])
+    day_limit = int(filtered_store.observed[filtered_store.index[anchor_country]].sum())
+    return {
+        "title": {
+            "text": f"Days since reaching {min_cases} cases vs Log-scale counts",
+            "y": 1,
+        },
+        "xaxis": {
+            "title": f"Days since reaching {min_cases} infections",
+            "range": [0, day_limit],
+        },
+        "yaxis": {"title": "Count"},
+        "yaxis_type": "log",
+    }
+
+
+def has_values(counts: np.ndarray) -> bool:
+    """A series can be drawn: it has at least one value (normalized metrics are NaN for
+    countries of unknown population)"""
+    return bool(np.isfinite(counts).any())
+
+
+def country_coordinates(infection_store: InfectionStore,
+                        countries: List[str],
+                        kind: Metric,
+                        aligned: bool = False) -> Dict[str, Optional[Coordinates]]:
+    """
+    Extract line coordinates of the given countries
+    :param infection_store: infection store
+    :param countries: country names
+    :param kind: infection status or derived series -- used to select metric
+    :param aligned: use days since the first observation instead of dates on the x axis
+    :return: x and y values by country, None for countries without data
+    """
+    coordinates = {}
+    for country in countries:
+        coordinates[country] = None
+        if country in infection_store.index:
+            dates, counts = infection_store.series(country, kind)
+            if has_values(counts):
+                coordinates[country] = (
+                    np.arange(counts.size) if aligned else dates,
+                    counts,
+                )
+    return coordinates
+
+
+def replace_traces(
+    figure: go.Figure,
+    coordinates: Dict[str, Optional[Coordinates]],
+    new_trace: Callable[[str, np.ndarray, np.ndarray], go.Scatter],
+) -> go.Figure:
+    """
+    Copy a figure and swap the coordinates of the named traces, leaving every other trace
+    as is
+    :param figure: figure to start from (left untouched)
+    :param coordinates: new x and y values by trace name; None removes the trace
+    :param new_trace: builds traces for names that are not in the figure yet
+    :return: updated copy of the figure
+    """
+    # the source figure has been validated when it was built, so copying need not
+    # repeat it
+    updated = go.Figure(figure, _validate=False)
+    positions = {trace.name: index for index, trace in enumerate(updated.data)}
+    with updated.batch_update():
+        for name, values in coordinates.items():
+            if values is not None and name in positions:
+                updated.data[positions[name]].x, updated.data[positions[name]].y = values
+    for name, values in coordinates.items():
+        if values is not None and name not in positions:
+            updated.add_trace(new_trace(name, *values))
+    if removed := {name for name, values in coordinates.items() if values is None}:
+        updated.data = [trace for trace in updated.data if trace.name not in removed]
+    return updated
+
 
 def plot_infection_curve(
-        infection_data: Infections,
-        kind: InfectionStatus = InfectionStatus.CONFIRMED
+        infection_store: InfectionStore,
+        kind: Metric = InfectionStatus.CONFIRMED,
+        merged: bool = False
 ) -> go.Figure:
     """
     Plot global infection curves by country
-    :param infection_data: a dictionary with the infection data
-    :param kind: either confirmed or deaths -- used to select metric
+    :param infection_store: infection store
+    :param kind: infection status or derived series -- used to select metric
+    :param merged: draw all countries as a single WebGL trace instead of a trace per
+    country
     :return: Figure object with the infection plot
     """
+    label = layout.metric_labels[kind.value]
     figure = go.Figure()
     plot_layout = {
         "title": {"text": "Infection Curves By Country"},
         "xaxis": {"title": "Date"},
         "yaxis": {"title": "Count"},
     }
-    for country, content in infection_data.items():
-        dates = [to_date(day["date"]) for day in content]
-        if counts := [day[kind.value] for day in content]:
-            lines = go.Scatter(x=dates, y=counts, opacity=0.25,
-                               name=country, mode="lines", showlegend=False,
-                               legendgroup=country, line=layout.line_style_layout,
-                               hovertemplate=layout.trace_hover_template(country))
-            figure.add_trace(lines)
+    if merged:
+        coordinates = country_coordinates(infection_store, infection_store.countries,
+                                          kind)
+        figure.add_trace(merged_lines_trace(
+            {country: values for country, values in coordinates.items()
+             if values is not None},
+            layout.trace_hover_template("%{customdata}", label)))
+    else:
+        for country in infection_store.countries:
+            dates, counts = infection_store.series(country, kind)
+            if has_values(counts):
+                figure.add_trace(infection_curve_trace(country, dates, counts, label))
     figure.update_layout(layout.global_layout)
     figure.update_layout(plot_layout)
     return figure
 
 
+def update_infection_curve(
+        figure: go.Figure,
+        infection_store: InfectionStore,
+        countries: List[str],
+        kind: Metric = InfectionStatus.CONFIRMED
+) -> go.Figure:
+    """
+    Incremental counterpart of plot_infection_curve that redraws the given countries only
+    :param figure: infection curve figure built from a previous version of the data
+    :param infection_store: infection store
+    :param countries: countries whose data changed
+    :param kind: infection status or derived series -- used to select metric
+    :return: updated copy of the figure
+    """
+    coordinates = country_coordinates(infection_store, countries, kind)
+    label = layout.metric_labels[kind.value]
+    return replace_traces(figure, coordinates,
+                          partial(infection_curve_trace, label=label))
+
+
 def plot_infection_trends(
-        infection_data: Infections,
-        kind: InfectionStatus = InfectionStatus.CONFIRMED,
-        min_cases: int = 100
+        infection_store: InfectionStore,
+        kind: Metric = InfectionStatus.CONFIRMED,
+        min_cases: int = 100,
+        growth: Optional[GrowthModels] = None,
+        merged: bool = False
 ) -> go.Figure:
     """
     Plot infection trends since hitting the threshold number of infections
     Note that the anchor country is used to set limit the number of days since beginning
-    :param infection_data: a dictionary with the infection data
-    :param kind: either confirmed or deaths -- used to select metric
-    :param min_cases: min number of cases needed to be plotted
+    :param infection_store: infection store
+    :param kind: infection status or normalized metric -- used to select metric
+    :param min_cases: min number of cases (of the metric's infection status) needed to be
+    plotted
+    :param growth: growth models of the plotted days, fitted here if not given
+    :param merged: draw all countries as a single WebGL trace instead of a trace per
+    country
     :return: a figure object
     """
-    anchor_country = str(config["anchor"])
-    filtered_infection_data = filter_infection_data(infection_data, kind=kind)
-    global_days, trend = fit_infection_trend(kind, filtered_infection_data)
-    day_limit = len(filtered_infection_data[anchor_country])
+    filtered_store = infection_store.filter(kind=base_status(kind), min_cases=min_cases)
+    growth = growth or fit_growth_models(kind, filtered_store, config["growth"]["window"])
+    label = layout.metric_labels[kind.value]
     figure = go.Figure()
-    plot_layout = {
-        "title": {"text": f"Days since reaching {min_cases} cases vs Log-scale counts", "y": 1},
-        "xaxis": {"title": f"Days since reaching {min_cases} infections", "range": [0, day_limit]},
-        "yaxis": {"title": "Count"},
-        "yaxis_type": "log",
-    }
-    for country, content in filtered_infection_data.items():
-        counts = [day[kind.value] for day in content]
-        days = [day for day in range(len(counts))]
-        if counts:
-            lines = go.Scatter(x=days, y=counts, name=country, opacity=0.25,
-                               mode="lines", line=layout.line_style_layout, showlegend=False,
-                               hovertemplate=layout.trace_hover_template(country))
-            figure.add_trace(lines)
-    trend_line = go.Scatter(x=global_days, y=trend, name="Trend", mode="lines",
-                            line={"color": layout.styles.default.alternative_color, "width": 3},
-                            showlegend=False, hovertemplate=layout.trace_hover_template("Trend"))
-    figure.add_trace(trend_line)
+    if merged:
+        coordinates = country_coordinates(filtered_store, filtered_store.countries, kind,
+                                          aligned=True)
+        coordinates = {country: values for country, values in coordinates.items()
+                       if values is not None}
+        figure.add_trace(merged_lines_trace(
+            coordinates,
+            layout.trend_hover_template("%{customdata}", details="", label=label),
+            details={country: growth.describe(country) for country in coordinates},
+            details_template=layout.trend_hover_template("%{customdata}", label=label)))
+    else:
+        for country in filtered_store.countries:
+            _, counts = filtered_store.series(country, kind)
+            if has_values(counts):
+                figure.add_trace(infection_trend_trace(country, np.arange(counts.size),
+                                                       counts, label))
+        annotate_growth(figure, growth, filtered_store.countries)
+    figure.add_trace(trend_line_trace(filtered_store, kind))
     figure.update_layout(layout.global_layout)
-    figure.update_layout(plot_layout)
+    figure.update_layout(trend_layout(filtered_store, min_cases))
     return figure
 
 
+def update_infection_trends(
+        figure: go.Figure,
+        infection_store: InfectionStore,
+        countries: List[str],
+        kind: Metric = InfectionStatus.CONFIRMED,
+        min_cases: int = 100,
+        growth: Optional[GrowthModels] = None
+) -> go.Figure:
+    """
+    Incremental counterpart of plot_infection_trends that redraws the given countries
+    and the trend line only
+    :param figure: infection trend figure built from a previous version of the data
+    :param infection_store: infection store
+    :param countries: countries whose data changed
+    :param kind: infection status or normalized metric -- used to select metric
+    :param min_cases: min number of cases (of the metric's infection status) needed to be
+    plotted
+    :param growth: growth models of the plotted days, fitted here if not given
+    :return: updated copy of the figure
+    """
+    filtered_store = infection_store.filter(kind=base_status(kind), min_cases=min_cases)
+    growth = growth or fit_growth_models(kind, filtered_store, config["growth"]["window"])
+    coordinates = country_coordinates(filtered_store, countries, kind, aligned=True)
+    coordinates["Trend"] = fit_infection_trend(kind, filtered_store)
+    label = layout.metric_labels[kind.value]
+    updated = replace_traces(figure, coordinates,
+                             partial(infection_trend_trace, label=label))
+    annotate_growth(updated, growth, countries)
+    updated.data = sorted(updated.data, key=lambda trace: trace.name == "Trend")
+    updated.update_layout(trend_layout(filtered_store, min_cases))
+    return updated
+
+
 def plot_infected_countries(
-        infection_data: Infections,
-        kind: InfectionStatus = InfectionStatus.CONFIRMED,
-        top_n: int = 20) -> go.Figure:
+        infection_store: InfectionStore,
+        kind: Metric = InfectionStatus.CONFIRMED,
+        top_n: int = 20,
+        column: int = -1) -> go.Figure:
     """
-    Plot a bar chart of top N countries with registered infections
-    :param infection_data: a dictionary with the infection data
-    :param kind: either confirmed or deaths -- used to select metric
+    Plot a bar chart of top N countries with registered infections. Countries are taken
+    from the store's ranking index, so any N and any date is a slice of a ranked column
+    :param infection_store: infection store
+    :param kind: infection status or derived series -- used to select metric
     :param top_n: top N number of countries to plot
+    :param column: date column to rank countries on (the latest date by default)
     :return: a plotly figure object
     """
+    label = layout.metric_labels[kind.value]
     plot_layout = {
         "title": {"text": f"Top {top_n} Countries"},
         "xaxis": {"title": "", "tickangle": 30, "tickfont": {"size": 8}},
-        "yaxis": {"title": "Cases"},
+        "yaxis": {"title": label},
     }
-
-    def sort_countries(data: dict, ascending: bool = True) -> list:
-        """Support function for country sorting"""
-        order = 1 if ascending else -1
-        return sorted(data.items(), key=lambda item: order * item[1][kind])
-
-    latest_data = {country: {
-        InfectionStatus.CONFIRMED: content[-1][InfectionStatus.CONFIRMED.value],
-        InfectionStatus.DEATHS: content[-1][InfectionStatus.DEATHS.value]}
-        for country, content in infection_data.items() if content}
-
-    top_countries = dict(sort_countries(latest_data, False)[0:top_n])
-    sorted_countries = dict(sort_countries(top_countries))
-    cases = [v[kind] for v in sorted_countries.values()]
-    countries = list(sorted_countries.keys())
+    top_rows, top_values = infection_store.ranking(kind).top(top_n, column)
+    cases = top_values[::-1].tolist()
+    countries = [infection_store.countries[row] for row in top_rows[::-1]]
     bar = go.Bar(x=countries, y=cases, showlegend=False,
                  marker={"color": layout.styles.default.color},
-                 hovertemplate=layout.bar_hover_template)
+                 hovertemplate=layout.bar_hover_template(label))
     figure = go.Figure()
     figure.add_trace(bar)
     figure.update_layout(layout.global_layout)
@@ -126,24 +347,43 @@ def plot_infected_countries(
     return figure
 
 
+def map_weights(infection_store: InfectionStore,
+                kind: Metric,
+                rows: np.ndarray) -> Optional[np.ndarray]:
+    """
+    Weights averaging the values of countries that share a name on the map: population for
+    counts per 100k, confirmed cases for deaths per case, counts of the infection status
+    for week-over-week changes; None (summed) for counts
+    """
+    derivation = getattr(kind, "derivation", None)
+    if derivation == Derivation.PER_100K:
+        return population_index([infection_store.countries[row] for row in rows])
+    if derivation == Derivation.PER_CASE:
+        return infection_store.latest(InfectionStatus.CONFIRMED)[rows]
+    if derivation == Derivation.WEEKLY_CHANGE:
+        return infection_store.latest(kind.kind)[rows]
+
+
 def plot_infection_map(
-        infection_data: Infections,
-        kind: InfectionStatus = InfectionStatus.CONFIRMED
+        infection_store: InfectionStore,
+        kind: Metric = InfectionStatus.CONFIRMED
 ) -> go.Figure:
     """
     Generate a choropleth map of infections by country
-    :param infection_data: a dictionary with the infection data
-    :param kind: either confirmed or deaths -- used to select metric
+    :param infection_store: infection store
+    :param kind: infection status or derived series -- used to select metric
     :return: a Plotly figure object
     """
-    map_data = {country: content[-1][kind.value]
-                for country, content in infection_data.items() if content}
-    translated_map_data = translate_countries(map_data)
-    countries = [c for c in translated_map_data.keys()]
-    infections = [i for i in translated_map_data.values()]
+    latest = infection_store.latest(kind)
+    rows = np.flatnonzero(infection_store.observed.any(axis=1) & np.isfinite(latest))
+    countries, infections = get_country_translator().translate(
+        [infection_store.countries[row] for row in rows], latest[rows],
+        map_weights(infection_store, kind, rows))
+    infections = infections.round(4).tolist()
+    hovertemplate = layout.map_hover_template(layout.metric_labels[kind.value])
     world_map = go.Choropleth(
         locations=countries, text=countries, locationmode="country names",
-        z=np.log10([i+1 for i in infections]), hovertemplate=layout.map_hover_template,
+        z=np.log10([max(i, 0)+1 for i in infections]), hovertemplate=hovertemplate,
         hovertext=infections, hoverlabel={"bgcolor": layout.styles.default.background_color},
         showscale=False, colorscale=[layout.styles.default.color, layout.styles.default.base_color])
     figure = go.Figure()
@@ -155,35 +395,210 @@ def plot_infection_map(
 @dataclass
 class FigureSet:
 
-    data: Infections
-    kind: InfectionStatus
+    data: InfectionStore
+    kind: Metric
+    growth: Optional[GrowthModels] = None
+    merged: bool = config["figures"]["merged_lines"]
 
     def __post_init__(self):
-        self.curve = FigureInstance("infection_curve",
-                                    plot_infection_curve(self.data, self.kind),
-                                    cb.reset_lines,
-                                    cb.highlight_lines)
-        self.trend = FigureInstance("infection_trend",
-                                    plot_infection_trends(self.data, self.kind),
-                                    cb.reset_lines,
-                                    cb.highlight_lines)
+        builders = {
+            "infection_curve": lambda: plot_infection_curve(self.data, self.kind,
+                                                            self.merged),
+            "infection_trend": lambda: plot_infection_trends(self.data, self.kind,
+                                                             growth=self.growth,
+                                                             merged=self.merged),
+            "infected_countries": lambda: plot_infected_countries(self.data, self.kind),
+            "infection_map": lambda: plot_infection_map(self.data, self.kind),
+        }
+        figures = {}
+        with profiler.phase(self.kind.value):
+            for id_str, build in builders.items():
+                with profiler.phase(id_str):
+                    figures[id_str] = build()
+        self.assign(figures)
+
+    @classmethod
+    def from_figures(cls,
+                     data: InfectionStore,
+                     kind: Metric,
+                     figures: Dict[str, go.Figure],
+                     growth: Optional[GrowthModels] = None,
+                     merged: bool = config["figures"]["merged_lines"]) -> "FigureSet":
+        """
+        Assemble a figure set from figures that have already been built
+        :param data: infection store the figures were built from
+        :param kind: metric of the figures
+        :param figures: figures by id
+        :param growth: growth models the trend figure was annotated with
+        :param merged: the line figures draw all countries as a single trace
+        :return: a figure set
+        """
+        figure_set = cls.__new__(cls)
+        figure_set.data, figure_set.kind, figure_set.growth = data, kind, growth
+        figure_set.merged = merged
+        figure_set.assign(figures)
+        return figure_set
+
+    def assign(self, figures: Dict[str, go.Figure]):
+        """Attach figures (by id) together with their highlight actions"""
+        if self.merged:
+            lines = (cb.highlight_merged, cb.patch_merged, cb.index_merged)
+        else:
+            lines = (cb.highlight_lines, cb.patch_lines, cb.index_lines)
+        self.curve = FigureInstance("infection_curve", figures["infection_curve"], *lines)
+        self.trend = FigureInstance("infection_trend", figures["infection_trend"], *lines)
         self.bars = FigureInstance("infected_countries",
-                                   plot_infected_countries(self.data, self.kind),
-                                   cb.reset_bars,
-                                   cb.highlight_bars)
+                                   figures["infected_countries"],
+                                   cb.highlight_bars,
+                                   cb.patch_bars,
+                                   cb.index_bars)
         self.map = FigureInstance("infection_map",
-                                  plot_infection_map(self.data, self.kind),
-                                  cb.reset_map,
-                                  cb.highlight_map)
+                                  figures["infection_map"],
+                                  cb.highlight_map,
+                                  cb.patch_map,
+                                  cb.index_map)
+
+    def instances(self) -> List[FigureInstance]:
+        """All figures of the set"""
+        return [self.curve, self.trend, self.bars, self.map]
+
+    def update(self,
+               data: InfectionStore,
+               delta: StoreDelta,
+               growth: Optional[GrowthModels] = None) -> "FigureSet":
+        """
+        Build the figure set of a newer version of the data, redrawing only the line
+        traces of countries in the delta (bars, map and merged lines are single traces
+        and are rebuilt)
+        :param data: updated infection store
+        :param delta: countries that changed since the data this set was built from
+        :param growth: growth models of the updated data
+        :return: a new figure set; this one is left untouched
+        """
+        if self.merged:
+            return FigureSet(data, self.kind, growth, merged=True)
+        countries = delta.countries + delta.removed
+        return FigureSet.from_figures(data, self.kind, {
+            "infection_curve": update_infection_curve(self.curve.figure, data, countries,
+                                                      self.kind),
+            "infection_trend": update_infection_trends(self.trend.figure, data, countries,
+                                                       self.kind, growth=growth),
+            "infected_countries": plot_infected_countries(data, self.kind),
+            "infection_map": plot_infection_map(data, self.kind),
+        }, growth, self.merged)
+
+
+class LazyFigureSets(Mapping):
+    """
+    Figure sets by metric, built on first access. At most maxsize sets are held at a time;
+    the least recently used one is dropped (and rebuilt if it is requested again)
+    """
+
+    def __init__(self,
+                 build: Callable[[Metric], FigureSet],
+                 metrics: Iterable[str],
+                 maxsize: int,
+                 built: Optional[Dict[str, FigureSet]] = None):
+        """
+        :param build: builds the figure set of a metric
+        :param metrics: metrics that can be requested
+        :param maxsize: max. number of figure sets held at a time
+        :param built: figure sets that have already been built, by metric
+        """
+        self.metrics = list(metrics)
+        self._build = build
+        self._lock = threading.Lock()
+        self._building = {metric: threading.Lock() for metric in self.metrics}
+        self._cache = LRUCache(maxsize=maxsize)
+        for metric, figure_set in (built or {}).items():
+            self._cache[metric] = figure_set
+
+    def __getitem__(self, metric: str) -> FigureSet:
+        if metric not in self.metrics:
+            raise KeyError(metric)
+        with self._lock:
+            figure_set = self._cache.get(metric)
+        if figure_set is not None:
+            return figure_set
+        # a metric is built once however many requests ask for it, and without holding
+        # the cache lock, so requests for the sets already built are not held up
+        with self._building[metric]:
+            with self._lock:
+                figure_set = self._cache.get(metric)
+            if figure_set is None:
+                figure_set = self._build(parse_metric(metric))
+                with self._lock:
+                    self._cache[metric] = figure_set
+        return figure_set
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.metrics)
+
+    def __len__(self) -> int:
+        return len(self.metrics)
+
+    def built(self) -> Dict[str, FigureSet]:
+        """Figure sets currently held, without building the others"""
+        with self._lock:
+            return dict(self._cache.items())
 
 
 @dataclass
 class Graphic:
 
-    data: Infections
+    data: InfectionStore
+    growth: Optional[Dict[str, GrowthModels]] = None
 
     def __post_init__(self):
-        self.figures = {
-            InfectionStatus.CONFIRMED.value: FigureSet(self.data, InfectionStatus.CONFIRMED),
-            InfectionStatus.DEATHS.value: FigureSet(self.data, InfectionStatus.DEATHS),
-        }
+        if self.growth is None:
+            self.growth = build_growth_models(self.data, config["growth"]["window"])
+        self.figures = self.lazy_figures()
+
+    def lazy_figures(self,
+                     built: Optional[Dict[str, FigureSet]] = None) -> LazyFigureSets:
+        """Figure sets of every metric, built from this graphic's data on first request"""
+        def build(kind: Metric) -> FigureSet:
+            return FigureSet(self.data, kind, self.growth[kind.value])
+
+        return LazyFigureSets(build,
+                              metrics=[metric.value for metric in METRICS
+                                       if metric in self.data.counts],
+                              maxsize=config["figures"]["cache_size"],
+                              built=built)
+
+    @classmethod
+    def from_figure_sets(cls,
+                         data: InfectionStore,
+                         figures: Dict[str, FigureSet],
+                         growth: Optional[Dict[str, GrowthModels]] = None) -> "Graphic":
+        """
+        Assemble a graphic from figure sets that have already been built; the sets of
+        other metrics are built on demand
+        :param data: infection store the figures were built from
+        :param figures: figure sets by metric
+        :param growth: growth models by metric, fitted from the data if not given
+        :return: a graphic
+        """
+        graphic = cls.__new__(cls)
+        graphic.data = data
+        graphic.growth = growth or build_growth_models(data, config["growth"]["window"])
+        graphic.figures = graphic.lazy_figures(figures)
+        return graphic
+
+    def update(self,
+               data: InfectionStore,
+               delta: StoreDelta,
+               growth: Optional[Dict[str, GrowthModels]] = None) -> "Graphic":
+        """
+        Incrementally rebuild the figure sets that have been built so far for a newer
+        version of the data (the others stay lazy)
+        :param data: updated infection store
+        :param delta: countries that changed since the data this graphic was built from
+        :param growth: growth models of the updated data by metric, fitted if not given
+        :return: a new graphic; this one is left untouched
+        """
+        growth = growth or build_growth_models(data, config["growth"]["window"])
+        return Graphic.from_figure_sets(data, {metric: figure_set.update(data, delta,
+                                                                         growth[metric])
+                                               for metric, figure_set
+                                               in self.figures.built().items()}, growth)
@@ -0,0 +1,138 @@
+"""
+Startup profiling. With COVID19_PROFILE_STARTUP set, the boot path records wall time and
+memory of every phase (imports, config, CSS parsing, fetch, parsing, filtering,
+statistics, each figure) and reports them once the app is ready, as a single JSON log line
+and, if the variable names a .json file, in that file. Import this module before anything
+else so that imports are timed too
+"""
+
+import builtins
+import json
+import logging
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from decouple import config
+
+logger = logging.getLogger(__name__)
+
+
+def memory_mb() -> float:
+    """Resident set size of this process in MB"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        return peak_memory_mb()
+
+
+def peak_memory_mb() -> float:
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+@dataclass
+class Phase:
+    """Time and memory spent in a (possibly repeated) phase of the boot"""
+    name: str
+    seconds: float = 0
+    memory_mb: float = 0
+    calls: int = 0
+
+
+class StartupProfiler:
+    """
+    Records phases of the boot path until finish is called; afterwards (and when disabled)
+    phases cost nothing but a flag check. Nested phases and imports are named after their
+    parents, e.g. snapshot/fetch or dash/plotly (import times include nested imports)
+    """
+
+    def __init__(self, enabled: bool, report_path: Optional[Path] = None):
+        """
+        :param enabled: record phases
+        :param report_path: file to write the report to, if any
+        """
+        self.enabled = enabled
+        self.report_path = report_path
+        self.started = time.perf_counter()
+        self.phases: Dict[str, Phase] = {}
+        self.imports: List[Phase] = []
+        self._stack: List[str] = []
+        self._importing: List[str] = []
+        self._import = builtins.__import__
+        if enabled:
+            builtins.__import__ = self._timed_import
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as a phase of the boot"""
+        if not self.enabled:
+            yield
+            return
+        self._stack.append(name)
+        path = "/".join(self._stack)
+        phase = self.phases.setdefault(path, Phase(path))
+        start, memory = time.perf_counter(), memory_mb()
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            phase.seconds += time.perf_counter() - start
+            phase.memory_mb += memory_mb() - memory
+            phase.calls += 1
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        package = name.partition(".")[0]
+        if level or package in sys.modules or package in self._importing:
+            return self._import(name, globals, locals, fromlist, level)
+        self._importing.append(package)
+        start, memory = time.perf_counter(), memory_mb()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            self.imports.append(Phase("/".join(self._importing),
+                                      time.perf_counter() - start,
+                                      memory_mb() - memory, 1))
+            self._importing.pop()
+
+    def report(self) -> dict:
+        """Phases recorded so far, in the order they were first entered"""
+        return {
+            "seconds": time.perf_counter() - self.started,
+            "memory_mb": memory_mb(),
+            "peak_memory_mb": peak_memory_mb(),
+            "imports": [asdict(phase) for phase in self.imports],
+            "phases": [asdict(phase) for phase in self.phases.values()],
+        }
+
+    def finish(self) -> Optional[dict]:
+        """
+        Stop recording and emit the report
+        :return: the report, None if profiling is disabled
+        """
+        if not self.enabled:
+            return None
+        builtins.__import__ = self._import
+        self.enabled = False
+        report = self.report()
+        logger.info(f"startup profile: {json.dumps(report)}")
+        if self.report_path is not None:
+            self.report_path.write_text(json.dumps(report, indent=2))
+        return report
+
+
+def startup_profiler() -> StartupProfiler:
+    """Profiler configured from COVID19_PROFILE_STARTUP (1/true, or a .json path)"""
+    setting = config("COVID19_PROFILE_STARTUP", default="")
+    report_path = Path(setting) if setting.endswith(".json") else None
+    enabled = report_path is not None or setting.lower() in ("1", "true", "yes", "on")
+    return StartupProfiler(enabled, report_path)
+
+
+profiler = startup_profiler()
@@ -0,0 +1,207 @@
+"""
+Periodic data refresh. Snapshots are rebuilt off the request path and swapped in whole
+"""
+
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from covid19.archive import read_archive, read_header, write_archive
+from covid19.data import InfectionStore, Payload
+from covid19.plots import Graphic
+from covid19.profiling import profiler
+from covid19.sources import data_source, DataSource, fetch_sources
+from covid19.stats import build_growth_models, build_summary_stats, GrowthModels
+from covid19.types import InfectionStatus, Summary
+from covid19.utils import get_app_dir, read_config
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(eq=False)
+class Snapshot:
+    """
+    Everything the app serves from a single version of the data. sources holds the
+    fingerprint of the payload of every source it was built from
+    """
+    raw: InfectionStore
+    data: InfectionStore
+    summary: Summary
+    graphic: Graphic
+    growth: Dict[str, GrowthModels]
+    created: datetime
+    version: Optional[str] = None
+    sources: Dict[str, dict] = field(default_factory=dict)
+
+
+def load_raw_store(source: DataSource,
+                   payload: Payload,
+                   cache_dir: Path,
+                   enabled: bool = True,
+                   compress: bool = False) -> InfectionStore:
+    """
+    Raw store of a source's payload, read from the source's archive when that was written
+    from this very payload, or else parsed from the payload and archived
+    :param source: data source
+    :param payload: payload of the source
+    :param cache_dir: directory for the archive
+    :param enabled: read and write the archive
+    :param compress: compress the archive
+    :return: raw infection store
+    """
+    if not enabled:
+        return source.parse(payload.chunks())
+    path, fingerprint = cache_dir / f"{source.name}.c19", payload.fingerprint()
+    if not payload.modified and path.exists():
+        try:
+            if read_header(path).get("source") == fingerprint:
+                logger.info(f"loading the infections archive {path}")
+                return read_archive(path)
+        except (OSError, ValueError) as error:
+            logger.warning(f"ignoring the infections archive {path} ({error})")
+    raw = source.parse(payload.chunks())
+    write_archive(raw, path, compress, fingerprint)
+    return raw
+
+
+def build_snapshot(previous: Optional[Snapshot] = None) -> Snapshot:
+    """
+    Fetch fresh infection data and build the summary and figures from it
+    :param previous: snapshot in service; when given (and incremental refresh is enabled)
+    only the changes since that snapshot are processed
+    :return: a new snapshot
+    """
+    config = read_config()
+    cache_dir = get_app_dir() / config["fetch"]["cache_dir"]
+    sources = [data_source(entry, config["fetch"]["timeout"])
+               for entry in config["sources"]]
+    with profiler.phase("fetch"):
+        payloads = fetch_sources(sources, cache_dir, config["fetch"]["workers"])
+    # compare with what the previous snapshot was built from rather than trusting a 304:
+    # the newer body may have been fetched by another worker, or by a build that failed
+    fingerprints = {name: payload.fingerprint() for name, payload in payloads.items()}
+    if previous is not None and previous.sources == fingerprints:
+        logger.info("payloads unchanged since the previous snapshot, keeping it")
+        return previous
+    with profiler.phase("parse"):
+        raw = InfectionStore.combine([load_raw_store(source, payloads[source.name],
+                                                     cache_dir, **config["archive"])
+                                      for source in sources if source.name in payloads])
+    if previous is not None and config["refresh"]["incremental"]:
+        return update_snapshot(previous, raw, fingerprints)
+    with profiler.phase("derive"):
+        derived = raw.derive(config["series"]["window"])
+    with profiler.phase("filter"):
+        store = derived.filter()
+    with profiler.phase("stats"):
+        growth = build_growth_models(store, config["growth"]["window"])
+        summary = build_summary_stats(store, growth[InfectionStatus.CONFIRMED.value])
+    graphic = Graphic(store, growth)
+    with profiler.phase("figures"):
+        for metric in config["figures"]["preload"]:
+            graphic.figures[metric]
+    return Snapshot(raw=raw,
+                    data=store,
+                    summary=summary,
+                    graphic=graphic,
+                    growth=growth,
+                    created=datetime.utcnow(),
+                    sources=fingerprints)
+
+
+def update_snapshot(previous: Snapshot,
+                    raw: InfectionStore,
+                    sources: Optional[Dict[str, dict]] = None) -> Snapshot:
+    """
+    Apply a newer version of the payload to a snapshot. Only the figures are updated
+    incrementally, redrawing the countries that gained or revised records; the derived
+    series, the filter, the growth models and the summary are computed again over the
+    whole store: together they take a fraction of the time the figures of a single metric
+    take to build, and a daily update changes nearly every country anyway
+    :param previous: snapshot built from an earlier version of the payload
+    :param raw: store of the newer version
+    :param sources: fingerprints of the payloads of the newer version
+    :return: a new snapshot, or the previous one if nothing changed
+    """
+    sources = sources or {}
+    delta = previous.raw.diff(raw)
+    if delta.empty:
+        logger.info("no changes since the previous snapshot")
+        previous.sources = sources
+        return previous
+    logger.info(f"incremental refresh: {len(delta.countries)} countries changed, "
+                f"{len(delta.removed)} removed")
+    config = read_config()
+    store = raw.derive(config["series"]["window"]).filter()
+    growth = build_growth_models(store, config["growth"]["window"])
+    confirmed = growth[InfectionStatus.CONFIRMED.value]
+    return Snapshot(raw=raw,
+                    data=store,
+                    summary=build_summary_stats(store, confirmed),
+                    graphic=previous.graphic.update(store, delta, growth),
+                    growth=growth,
+                    created=datetime.utcnow(),
+                    sources=sources)
+
+
+class SnapshotRefresher:
+    """
+    Holds the current snapshot and replaces it on a schedule from a background thread.
+    Readers always get a complete snapshot: the reference is swapped only once the
+    replacement is fully built, and a failed rebuild keeps the previous one in service
+    """
+
+    def __init__(self, build: Callable[[Optional[Snapshot]], Snapshot], interval: float):
+        """
+        :param build: a callable producing a new snapshot from the one in service
+        (called once immediately, with None)
+        :param interval: number of seconds between refreshes
+        """
+        self.interval = interval
+        self._build = build
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._snapshot = build(None)
+
+    @property
+    def snapshot(self) -> Snapshot:
+        """The snapshot currently in service"""
+        return self._snapshot
+
+    def refresh(self) -> bool:
+        """
+        Rebuild the snapshot and swap it in
+        :return: True if the snapshot was replaced
+        """
+        with self._lock:
+            try:
+                snapshot = self._build(self._snapshot)
+            except Exception:
+                logger.exception("snapshot refresh failed, keeping the previous snapshot")
+                return False
+            self._snapshot = snapshot
+        logger.info("snapshot refreshed")
+        return True
+
+    def start(self) -> "SnapshotRefresher":
+        """Start refreshing in a daemon thread"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="snapshot-refresher",
+                                            daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the background thread"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.refresh()
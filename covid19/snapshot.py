@@ -0,0 +1,259 @@
+"""
+Snapshots persisted to disk so that every worker maps the same copy of the data.
+A snapshot directory holds one subdirectory per version (the raw store as an infection
+archive, the arrays of the filtered store and of the growth models as .npy files,
+pre-serialized figures of the metrics built so far as JSON and an index.json describing
+them along with the summary stats) and a `current` file naming the version in service
+"""
+
+import base64
+import fcntl
+import json
+import logging
+import shutil
+import time
+from dataclasses import fields
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Optional, Union
+
+import numpy as np
+import plotly.graph_objects as go
+
+from covid19.archive import read_archive, write_archive
+from covid19.data import InfectionStore
+from covid19.plots import FigureSet, Graphic
+from covid19.profiling import profiler
+from covid19.refresh import build_snapshot, Snapshot
+from covid19.stats import GrowthModels
+from covid19.types import parse_metric, Summary, SummaryDate
+from covid19.utils import atomic_write
+
+logger = logging.getLogger(__name__)
+
+VERSION_FORMAT = "%Y%m%dT%H%M%S%f"
+GROWTH_ARRAYS = ("slope", "intercept", "r_squared", "residual_std", "observations",
+                 "day_mean", "day_spread")
+
+
+def save_store(store: InfectionStore, directory: Path, name: str) -> dict:
+    """
+    Write the arrays of a store as .npy files
+    :param store: infection store
+    :param directory: version directory
+    :param name: prefix of the files
+    :return: index entry describing the store
+    """
+    np.save(str(directory / f"{name}.dates.npy"), store.dates)
+    np.save(str(directory / f"{name}.observed.npy"), store.observed)
+    for kind, values in store.counts.items():
+        np.save(str(directory / f"{name}.{kind.value}.npy"), values)
+    for kind, values in store.totals.items():
+        np.save(str(directory / f"{name}.total.{kind.value}.npy"), values)
+    return {"countries": store.countries,
+            "kinds": [kind.value for kind in store.counts],
+            "totals": [kind.value for kind in store.totals]}
+
+
+def load_store(directory: Path, name: str, entry: dict) -> InfectionStore:
+    """
+    Map the arrays of a store read-only
+    :param directory: version directory
+    :param name: prefix of the files
+    :param entry: index entry written by save_store
+    :return: infection store backed by memory-mapped arrays
+    """
+    def load(suffix: str) -> np.ndarray:
+        return np.load(str(directory / f"{name}.{suffix}.npy"), mmap_mode="r")
+
+    return InfectionStore(countries=entry["countries"],
+                          dates=load("dates"),
+                          counts={parse_metric(kind): load(kind)
+                                  for kind in entry["kinds"]},
+                          observed=load("observed"),
+                          totals={parse_metric(kind): load(f"total.{kind}")
+                                  for kind in entry.get("totals", [])})
+
+
+def save_growth(growth: Dict[str, GrowthModels], directory: Path) -> dict:
+    """
+    Write the arrays of the growth models as .npy files
+    :param growth: growth models by metric
+    :param directory: version directory
+    :return: index entry describing the models
+    """
+    for metric, models in growth.items():
+        for name in GROWTH_ARRAYS:
+            np.save(str(directory / f"growth.{metric}.{name}.npy"), getattr(models, name))
+    return {metric: {"countries": models.countries, "window": models.window}
+            for metric, models in growth.items()}
+
+
+def load_growth(directory: Path, entry: dict) -> Dict[str, GrowthModels]:
+    """
+    Map the arrays of the growth models read-only
+    :param directory: version directory
+    :param entry: index entry written by save_growth
+    :return: growth models by metric
+    """
+    return {metric: GrowthModels(countries=models["countries"],
+                                 window=models["window"],
+                                 **{name: np.load(str(directory
+                                                      / f"growth.{metric}.{name}.npy"),
+                                                  mmap_mode="r")
+                                    for name in GROWTH_ARRAYS})
+            for metric, models in entry.items()}
+
+
+def encode_summary(summary: Summary) -> dict:
+    """Summary stats as an index entry (the date in VERSION_FORMAT)"""
+    entry = {}
+    for field in fields(Summary):
+        stat = getattr(summary, field.name)
+        value = stat.value
+        if isinstance(stat, SummaryDate):
+            value = value.strftime(VERSION_FORMAT)
+        entry[field.name] = {"title": stat.title, "value": value}
+    return entry
+
+
+def decode_summary(entry: dict) -> Summary:
+    """Summary stats from an index entry written by encode_summary"""
+    stats = {}
+    for field in fields(Summary):
+        title, value = entry[field.name]["title"], entry[field.name]["value"]
+        if field.type is SummaryDate:
+            value = datetime.strptime(value, VERSION_FORMAT)
+        stats[field.name] = field.type(title=title, value=value)
+    return Summary(**stats)
+
+
+def decode_typed_array(value: dict) -> Union[dict, np.ndarray]:
+    """json.loads object hook turning plotly's base64 typed-array specs into arrays"""
+    if "bdata" in value and "dtype" in value:
+        array = np.frombuffer(base64.b64decode(value["bdata"]), dtype=value["dtype"])
+        if shape := value.get("shape"):
+            array = array.reshape([int(dim) for dim in str(shape).split(",")])
+        return array
+    return value
+
+
+def current_version(root: Path) -> Optional[str]:
+    """Version in service, if any"""
+    pointer = root / "current"
+    return pointer.read_text().strip() if pointer.exists() else None
+
+
+def write_snapshot(snapshot: Snapshot, root: Path, keep: int = 2) -> str:
+    """
+    Persist a snapshot as a new version and put it in service. Only the figure sets
+    built so far are written; readers build the others when they are requested
+    :param snapshot: snapshot to persist
+    :param root: snapshot directory
+    :param keep: number of versions to retain (older ones may still be mapped by workers)
+    :return: the new version
+    """
+    version = snapshot.created.strftime(VERSION_FORMAT)
+    directory = root / version
+    directory.mkdir(parents=True, exist_ok=True)
+    write_archive(snapshot.raw, directory / "raw.c19")
+    index = {
+        "created": version,
+        "stores": {"data": save_store(snapshot.data, directory, "data")},
+        "growth": save_growth(snapshot.growth, directory),
+        "summary": encode_summary(snapshot.summary),
+        "figures": {},
+        "sources": snapshot.sources,
+    }
+    for metric, figure_set in snapshot.graphic.figures.built().items():
+        index["figures"][metric] = {}
+        for instance in figure_set.instances():
+            file_name = f"{metric}.{instance.id_str}.json"
+            atomic_write(directory / file_name, instance.json)
+            index["figures"][metric][instance.id_str] = file_name
+    atomic_write(directory / "index.json", json.dumps(index).encode())
+    atomic_write(root / "current", version.encode())
+    for stale in sorted(path for path in root.iterdir() if path.is_dir())[:-keep]:
+        shutil.rmtree(str(stale), ignore_errors=True)
+    logger.info(f"wrote snapshot {version}")
+    return version
+
+
+def read_snapshot(root: Path, version: Optional[str] = None) -> Snapshot:
+    """
+    Load a persisted snapshot: the raw archive and the arrays of the store and growth
+    models are memory-mapped, the summary stats are read as they were computed and
+    figures are decoded without re-validation, since they were validated when they were
+    built (their JSON is kept as the pre-serialized form of the figures)
+    :param root: snapshot directory
+    :param version: version to load, defaults to the one in service
+    :return: snapshot
+    """
+    version = version or current_version(root)
+    directory = root / version
+    index = json.loads((directory / "index.json").read_text())
+    raw = read_archive(directory / "raw.c19")
+    data = load_store(directory, "data", index["stores"]["data"])
+    growth = load_growth(directory, index["growth"])
+    figure_sets = {}
+    for metric, files in index["figures"].items():
+        serialized = {id_str: (directory / file_name).read_bytes()
+                      for id_str, file_name in files.items()}
+        figures = {id_str: go.Figure(json.loads(body, object_hook=decode_typed_array),
+                                     _validate=False)
+                   for id_str, body in serialized.items()}
+        figure_sets[metric] = FigureSet.from_figures(data, parse_metric(metric), figures,
+                                                     growth[metric])
+        for instance in figure_sets[metric].instances():
+            # no need to serialize again
+            instance.__dict__["json"] = serialized[instance.id_str]
+    return Snapshot(raw=raw,
+                    data=data,
+                    summary=decode_summary(index["summary"]),
+                    graphic=Graphic.from_figure_sets(data, figure_sets, growth),
+                    growth=growth,
+                    created=datetime.strptime(index["created"], VERSION_FORMAT),
+                    version=version,
+                    sources=index.get("sources", {}))
+
+
+def shared_snapshot(root: Path,
+                    max_age: float,
+                    build: Callable[[Optional[Snapshot]], Snapshot] = build_snapshot
+                    ) -> Callable[[Optional[Snapshot]], Snapshot]:
+    """
+    Make a snapshot builder for SnapshotRefresher that shares work between processes.
+    Under an exclusive file lock, the first process to find the persisted snapshot
+    missing or not checked for max_age seconds builds and writes a new one (or, if the
+    data has not changed, just marks the current one as checked); every process then
+    maps whichever version is in service
+    :param root: snapshot directory
+    :param max_age: seconds after which the persisted snapshot is rebuilt
+    :param build: builds a snapshot from the previous one
+    :return: builder function
+    """
+    def load_or_build(previous: Optional[Snapshot]) -> Snapshot:
+        root.mkdir(parents=True, exist_ok=True)
+        pointer = root / "current"
+        with open(str(root / "build.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                version = current_version(root)
+                if version is None or time.time() - pointer.stat().st_mtime >= max_age:
+                    stale = previous is None or previous.version != version
+                    if version is not None and stale:
+                        previous = read_snapshot(root, version)
+                    snapshot = build(previous)
+                    if snapshot is previous and version is not None:
+                        atomic_write(pointer, version.encode())
+                    else:
+                        with profiler.phase("write"):
+                            version = write_snapshot(snapshot, root)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        if previous is not None and previous.version == version:
+            return previous
+        with profiler.phase("read"):
+            return read_snapshot(root, version)
+
+    return load_or_build
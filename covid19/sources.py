@@ -0,0 +1,149 @@
+"""
+Data sources. Every configured feed (national, sub-national...) is fetched through a
+DataSource adapter and normalized by the parser of its format into an infection store; the
+stores are then combined into the one the app is built from. Sources are fetched
+concurrently, each with its own timeout and cache policy, so a slow feed does not hold up
+the others
+"""
+
+import logging
+import time
+from abc import ABC, abstractmethod
+from concurrent import futures
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from covid19.data import cache_paths, fetch_payload, InfectionStore, Payload
+from covid19.ingest import parse_csv_infections, parse_infections
+from covid19.utils import atomic_write, get_app_dir
+
+logger = logging.getLogger(__name__)
+
+FORMATS: Dict[str, Callable[[Iterable[bytes]], InfectionStore]] = {
+    "timeseries": parse_infections,
+    "csv": parse_csv_infections,
+}
+
+
+@dataclass
+class DataSource(ABC):
+    """
+    A feed of infection data
+    :param name: identifies the source, e.g. in logs and cache files
+    :param location: where the feed is read from
+    :param format: one of FORMATS
+    :param timeout: seconds to wait for the feed
+    :param max_age: seconds during which a cached copy is used without checking for a
+    newer one
+    :param required: a refresh fails without this source, rather than going ahead without
+    it
+    """
+    name: str
+    location: str
+    format: str = "timeseries"
+    timeout: float = 30
+    max_age: float = 0
+    required: bool = True
+
+    @abstractmethod
+    def fetch(self, cache_dir: Path) -> Payload:
+        """
+        Retrieve the latest payload
+        :param cache_dir: directory for cached copies
+        :return: payload, not modified if it is the same as the last one retrieved
+        """
+
+    @abstractmethod
+    def cached(self, cache_dir: Path) -> Optional[Payload]:
+        """Last payload retrieved, if any"""
+
+    def parse(self, chunks: Iterable[bytes]) -> InfectionStore:
+        """Normalize a payload into an infection store"""
+        return FORMATS[self.format](chunks)
+
+
+class HttpSource(DataSource):
+    """A feed served over HTTP, fetched conditionally and cached on disk"""
+
+    def fetch(self, cache_dir: Path) -> Payload:
+        return fetch_payload(self.location, cache_dir, self.timeout, max_age=self.max_age)
+
+    def cached(self, cache_dir: Path) -> Optional[Payload]:
+        body_path, _ = cache_paths(self.location, cache_dir)
+        return Payload(path=body_path, modified=False) if body_path.exists() else None
+
+
+class FileSource(DataSource):
+    """A feed read from a local file, modified whenever the file is replaced or changed"""
+
+    def fetch(self, cache_dir: Path) -> Payload:
+        payload = Payload(path=Path(self.location), modified=True)
+        seen_path = cache_dir / f"{self.name}.seen.json"
+        fingerprint = str(payload.fingerprint()).encode()
+        if seen_path.exists() and seen_path.read_bytes() == fingerprint:
+            payload.modified = False
+        else:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            atomic_write(seen_path, fingerprint)
+        return payload
+
+    def cached(self, cache_dir: Path) -> Optional[Payload]:
+        path = Path(self.location)
+        return Payload(path=path, modified=False) if path.exists() else None
+
+
+def data_source(entry: dict, default_timeout: float = 30) -> DataSource:
+    """
+    Make a source from its configuration: an HTTP source if it has a url,
+    a file source (relative to the app directory) if it has a path
+    """
+    options = {key: entry[key] for key in ("format", "max_age", "required")
+               if key in entry}
+    timeout = entry.get("timeout", default_timeout)
+    if "url" in entry:
+        return HttpSource(entry["name"], entry["url"], timeout=timeout, **options)
+    return FileSource(entry["name"], str(get_app_dir() / entry["path"]), timeout=timeout,
+                      **options)
+
+
+def fetch_sources(sources: List[DataSource],
+                  cache_dir: Path,
+                  workers: int = 4) -> Dict[str, Payload]:
+    """
+    Fetch sources concurrently. A source that fails or runs past its timeout is served
+    from its last cached copy; without one, it is left out, or the error is raised
+    if the source is required
+    :param sources: sources to fetch
+    :param cache_dir: directory for cached copies
+    :param workers: max. number of sources fetched at a time
+    :return: payload by source name, in the order of the sources
+    """
+    executor = futures.ThreadPoolExecutor(max_workers=max(min(workers, len(sources)), 1),
+                                          thread_name_prefix="fetch")
+    start = time.perf_counter()
+    pending: Dict[str, futures.Future] = {
+        source.name: executor.submit(source.fetch, cache_dir) for source in sources}
+    payloads = {}
+    try:
+        for source in sources:
+            remaining = max(start + source.timeout - time.perf_counter(), 0)
+            try:
+                payloads[source.name] = pending[source.name].result(timeout=remaining)
+                continue
+            except futures.TimeoutError:
+                error = TimeoutError(f"no response within {source.timeout} seconds")
+            except Exception as failure:
+                error = failure
+            if (cached := source.cached(cache_dir)) is not None:
+                logger.warning(f"failed to fetch source {source.name} ({error}), "
+                               "using the cached copy")
+                payloads[source.name] = cached
+            elif source.required:
+                raise error
+            else:
+                logger.warning(f"failed to fetch source {source.name} ({error}), "
+                               "leaving it out")
+    finally:
+        executor.shutdown(wait=False)
+    return payloads
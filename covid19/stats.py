@@ -1,55 +1,220 @@
 """Statistical models"""
-from datetime import datetime
-from typing import Tuple
+from dataclasses import dataclass, field
+from statistics import NormalDist
+from typing import Dict, Optional, Tuple
 from typing import Union, List
 
 import numpy as np
-from sklearn.linear_model import LinearRegression
 
 from covid19 import types as t
+from covid19.data import InfectionStore
 from covid19.utils import read_config
 
 config = read_config()
 
 
-def fit_infection_trend(kind: t.InfectionStatus,
-                        infection_data: t.Infections) -> Tuple[list, list]:
+@dataclass
+class LinearFit:
+    """Least-squares line y = intercept + slope * x"""
+    slope: float
+    intercept: float
+
+    def predict(self, x: np.ndarray) -> np.ndarray:
+        return self.intercept + self.slope * x
+
+
+def fit_log_linear(counts: np.ndarray, valid: np.ndarray) -> LinearFit:
+    """
+    Fit log10(count) against the column number in closed form, from sums over the valid
+    cells
+    :param counts: count matrix with one row per series and one column per day
+    :param valid: mask of the cells to fit
+    :return: fitted line (of log10 counts)
+    """
+    x = np.broadcast_to(np.arange(counts.shape[1], dtype=float), counts.shape)[valid]
+    y = np.log10(counts[valid])
+    n = x.size
+    x_mean, y_mean = x.sum() / n, y.sum() / n
+    sxx = np.dot(x, x) - n * x_mean * x_mean
+    sxy = np.dot(x, y) - n * x_mean * y_mean
+    slope = sxy / sxx if sxx else 0.0
+    return LinearFit(slope=float(slope), intercept=float(y_mean - slope * x_mean))
+
+
+def fit_infection_trend(kind: t.Metric,
+                        infection_store: InfectionStore) -> Tuple[np.ndarray, np.ndarray]:
     """
     Fit a linear model to the log of infection data
-    :param kind: Infection status (deaths, confirmed, recovered)
-    :param infection_data: infection data
+    :param kind: Infection status (deaths, confirmed, recovered) or a normalized metric
+    :param infection_store: filtered infection store
     :return: A tuple of unique days  (from zero) and predicted infections for that day
+    (whole numbers for infection statuses)
+    """
+    included = np.array([country not in config["exclude"]["trend"]
+                         for country in infection_store.countries], dtype=bool)
+    counts, valid = infection_store.aligned(kind)
+    counts, valid = counts[included], valid[included] & (counts[included] > 0)
+    trend_days = np.flatnonzero(valid.any(axis=0))
+    predictions = np.power(10, fit_log_linear(counts, valid).predict(trend_days))
+    if isinstance(kind, t.InfectionStatus):
+        return trend_days, predictions.astype(np.int64)
+    return trend_days, predictions
+
+
+@dataclass(eq=False)
+class GrowthModels:
+    """
+    Log-linear models log10(count) = intercept + slope * day, one per country, where days
+    count from the country's first observation. Models are fitted over the last window
+    observed days of every country (all of them if window is None); entries are NaN for
+    countries with fewer than three observations in the window
+    """
+    countries: List[str]
+    slope: np.ndarray
+    intercept: np.ndarray
+    r_squared: np.ndarray
+    residual_std: np.ndarray
+    observations: np.ndarray
+    day_mean: np.ndarray
+    day_spread: np.ndarray
+    window: Optional[int] = None
+    index: Dict[str, int] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.index = {country: row for row, country in enumerate(self.countries)}
+
+    @property
+    def growth_rate(self) -> np.ndarray:
+        """Daily growth rate of every country"""
+        return np.power(10, self.slope) - 1
+
+    @property
+    def doubling_time(self) -> np.ndarray:
+        """Days it takes every country's count to double, inf where it is not growing"""
+        with np.errstate(divide="ignore"):
+            return np.where(self.slope > 0, np.log10(2) / self.slope, np.where(
+                np.isnan(self.slope), np.nan, np.inf))
+
+    def predict(self, days: np.ndarray) -> np.ndarray:
+        """
+        Fitted counts
+        :param days: days since the first observation
+        :return: count matrix with one row per country and one column per day
+        """
+        return np.power(10, self.intercept[:, None] + self.slope[:, None] * days)
+
+    def interval(self,
+                 days: np.ndarray,
+                 level: float = 0.95) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Prediction intervals of the counts (normal approximation of the log10 residuals)
+        :param days: days since the first observation
+        :param level: probability covered by the interval
+        :return: a tuple of lower and upper count matrices (one row per country)
+        """
+        z = NormalDist().inv_cdf(0.5 + level / 2)
+        fitted = self.intercept[:, None] + self.slope[:, None] * days
+        spread = self.residual_std[:, None] * np.sqrt(
+            1 + 1 / self.observations[:, None]
+            + (days - self.day_mean[:, None]) ** 2 / self.day_spread[:, None])
+        return np.power(10, fitted - z * spread), np.power(10, fitted + z * spread)
+
+    def describe(self, country: str) -> str:
+        """Short description of a country's growth for hover labels"""
+        row = self.index.get(country)
+        if row is None or np.isnan(self.slope[row]):
+            return "Growth: not enough data"
+        if self.slope[row] <= 0:
+            return "Growth: not growing"
+        return (f"Growth: {self.growth_rate[row]:.1%} a day, "
+                f"doubling every {self.doubling_time[row]:.1f} days")
+
+
+def fit_growth_models(kind: t.Metric,
+                      infection_store: InfectionStore,
+                      window: Optional[int] = None) -> GrowthModels:
     """
-    linear_model = LinearRegression()
-    predictors, response = [], []
-    for country, content in infection_data.items():
-        if country not in config["exclude"]["trend"]:
-            counts = [day[kind.value] for day in content]
-            days = [day for day in range(len(counts))]
-            predictors.extend(days)
-            response.extend(np.log10(counts))
-    trend_days = sorted(list(set(predictors)))
-    linear_model.fit(np.array(predictors).reshape(-1, 1), response)
-    predictions = linear_model.predict(np.array(trend_days).reshape(-1, 1))
-    rescaled_predictions = [int(np.power(10, p)) for p in predictions]
-    return trend_days, rescaled_predictions
-
-
-def build_summary_stats(infection_data: t.Infections) -> t.Summary:
+    Fit a log-linear model to every country at once from masked sums over the aligned
+    countries x days matrix (days without a positive value are left out)
+    :param kind: Infection status (deaths, confirmed, recovered) or a normalized metric
+    :param infection_store: filtered infection store
+    :param window: number of most recent observed days to fit (all if None)
+    :return: growth models of all countries in the store
+    """
+    counts, valid = infection_store.aligned(kind)
+    valid = valid & (counts > 0)
+    if window is not None:
+        rank = np.cumsum(valid, axis=1)
+        valid &= rank > (valid.sum(axis=1) - window)[:, None]
+    days = np.arange(counts.shape[1], dtype=float)
+    log_counts = np.log10(np.where(valid, counts, 1))
+    observations = valid.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        day_mean = np.where(valid, days, 0).sum(axis=1) / observations
+        log_mean = np.where(valid, log_counts, 0).sum(axis=1) / observations
+        day_dev = np.where(valid, days - day_mean[:, None], 0)
+        log_dev = np.where(valid, log_counts - log_mean[:, None], 0)
+        sxx = (day_dev * day_dev).sum(axis=1)
+        sxy = (day_dev * log_dev).sum(axis=1)
+        syy = (log_dev * log_dev).sum(axis=1)
+        slope = sxy / sxx
+        residual = np.maximum(syy - slope * sxy, 0)
+        r_squared = np.where(syy > 0, 1 - residual / syy, 1.0)
+        residual_std = np.sqrt(residual / (observations - 2))
+    fitted = observations >= 3
+    return GrowthModels(countries=list(infection_store.countries),
+                        slope=np.where(fitted, slope, np.nan),
+                        intercept=np.where(fitted, log_mean - slope * day_mean, np.nan),
+                        r_squared=np.where(fitted, r_squared, np.nan),
+                        residual_std=np.where(fitted, residual_std, np.nan),
+                        observations=observations,
+                        day_mean=day_mean,
+                        day_spread=sxx,
+                        window=window)
+
+
+def build_growth_models(infection_store: InfectionStore,
+                        window: Optional[int] = None,
+                        min_cases: int = 100) -> Dict[str, GrowthModels]:
+    """
+    Fit growth models of every metric the store has, on the same days the trend plot shows
+    :param infection_store: filtered infection store
+    :param window: number of most recent observed days to fit (all if None)
+    :param min_cases: min number of cases (of the metric's infection status) for a day
+    to be fitted
+    :return: growth models by metric
+    """
+    filtered = {kind: infection_store.filter(kind, min_cases)
+                for kind in t.InfectionStatus if kind in infection_store.counts}
+    return {metric.value: fit_growth_models(metric, filtered[t.base_status(metric)],
+                                            window)
+            for metric in t.METRICS if metric in infection_store.counts}
+
+
+def build_summary_stats(infection_store: InfectionStore,
+                        growth: Optional[GrowthModels] = None) -> t.Summary:
     """
     Build summary stats from the infection dataset
-    :param infection_data: a dictionary with infection records
+    :param infection_store: filtered infection store
+    :param growth: growth models of confirmed cases, fitted from the store if not given
     :return: a dictionary with summary stats
     """
-    last_update = max([datetime.strptime(c, "%Y-%m-%d") for c in get_cases(infection_data, "date")])
-    cases_yesterday = sum(get_cases(infection_data, t.InfectionStatus.CONFIRMED.value, 2))
-    cases = sum(get_cases(infection_data, t.InfectionStatus.CONFIRMED.value))
-    deaths = sum(get_cases(infection_data, t.InfectionStatus.DEATHS.value))
+    if growth is None:
+        growth = fit_growth_models(t.InfectionStatus.CONFIRMED, infection_store,
+                                   config["growth"]["window"])
+    doubling_times = growth.doubling_time[~np.isnan(growth.slope)]
+    last_update = infection_store.last_update()
+    cases_yesterday = int(infection_store.latest(t.InfectionStatus.CONFIRMED, 2).sum())
+    cases = int(infection_store.latest(t.InfectionStatus.CONFIRMED).sum())
+    deaths = int(infection_store.latest(t.InfectionStatus.DEATHS).sum())
     return t.Summary(
         last_update=t.SummaryDate(title="Last update", value=last_update),
         total_cases=t.SummaryCount(title="Global cases", value=cases),
         total_deaths=t.SummaryCount(title="Global deaths", value=deaths),
         global_growth=t.SummaryPercentage(title="Latest growth", value=cases/cases_yesterday-1),
+        doubling_time=t.SummaryDuration(title="Median doubling time",
+                                        value=float(np.median(doubling_times))
+                                        if doubling_times.size else float("nan")),
     )
 
 
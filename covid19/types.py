@@ -4,9 +4,12 @@ from abc import ABC
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
+from functools import cached_property
 from typing import Dict, List, Union, Optional, TypeVar, Generic, Callable
 
+import numpy as np
 import plotly.graph_objects as go
+from dash import Patch
 
 Infections = Dict[str, List[Dict[str, Union[str, int]]]]
 HoverData = Optional[Dict[str, List[Dict[str, Union[int, str]]]]]
@@ -20,6 +23,61 @@ class InfectionStatus(Enum):
     DEATHS = "deaths"
 
 
+class Derivation(Enum):
+    """Series derived from cumulative counts"""
+    DAILY = "daily"
+    AVERAGE = "average"
+    WEEKLY_CHANGE = "weekly_change"
+    PER_100K = "per_100k"
+    PER_CASE = "per_case"
+
+
+@dataclass(frozen=True)
+class DerivedStatus:
+    """Key of a derived series, used alongside InfectionStatus to select counts"""
+    kind: InfectionStatus
+    derivation: Derivation
+
+    @property
+    def value(self) -> str:
+        return f"{self.kind.value}_{self.derivation.value}"
+
+
+Metric = Union[InfectionStatus, DerivedStatus]
+
+
+METRICS: List[Metric] = [
+    InfectionStatus.CONFIRMED,
+    InfectionStatus.DEATHS,
+    DerivedStatus(InfectionStatus.CONFIRMED, Derivation.DAILY),
+    DerivedStatus(InfectionStatus.DEATHS, Derivation.DAILY),
+    DerivedStatus(InfectionStatus.CONFIRMED, Derivation.AVERAGE),
+    DerivedStatus(InfectionStatus.DEATHS, Derivation.AVERAGE),
+    DerivedStatus(InfectionStatus.CONFIRMED, Derivation.WEEKLY_CHANGE),
+    DerivedStatus(InfectionStatus.DEATHS, Derivation.WEEKLY_CHANGE),
+    DerivedStatus(InfectionStatus.CONFIRMED, Derivation.PER_100K),
+    DerivedStatus(InfectionStatus.DEATHS, Derivation.PER_100K),
+    DerivedStatus(InfectionStatus.DEATHS, Derivation.PER_CASE),
+]
+"""Metrics that can be selected, in the order they are offered (if the data has them)"""
+
+
+def base_status(metric: Metric) -> InfectionStatus:
+    """Infection status a metric is computed from"""
+    return metric if isinstance(metric, InfectionStatus) else metric.kind
+
+
+def parse_metric(value: str) -> Metric:
+    """Metric with the given value, e.g. deaths or confirmed_daily"""
+    for kind in InfectionStatus:
+        if value == kind.value:
+            return kind
+        for derivation in Derivation:
+            if value == DerivedStatus(kind, derivation).value:
+                return DerivedStatus(kind, derivation)
+    raise ValueError(f"{value!r} is not a valid metric")
+
+
 @dataclass
 class __SummaryStat(ABC, Generic[T]):
 
@@ -51,17 +109,93 @@ class SummaryPercentage(__SummaryStat[float]):
         self.value_str: str = f"{self.value:.2%}"
 
 
+@dataclass
+class SummaryDuration(__SummaryStat[float]):
+    def __post_init__(self):
+        super().__post_init__()
+        if np.isnan(self.value):
+            self.value_str: str = "n/a"
+        elif np.isinf(self.value):
+            self.value_str: str = "not growing"
+        else:
+            self.value_str: str = f"{self.value:.1f} days"
+
+
 @dataclass
 class Summary:
     last_update: SummaryDate
     total_cases: SummaryCount
     total_deaths: SummaryCount
     global_growth: SummaryPercentage
+    doubling_time: SummaryDuration
 
 
 @dataclass
 class FigureInstance:
+    """
+    A figure together with its highlight actions. Both the figure and its serialized base
+    are shared between requests and must not be mutated; highlighting returns an overlay
+    that only copies what it changes. Countries are located through an index that is
+    built once per figure
+    """
     id_str: str
     figure: go.Figure
-    reset: Callable[[go.Figure], go.Figure]
-    highlight: Callable[[go.Figure, str], go.Figure]
+    highlight: Callable[["FigureInstance", str], dict]
+    patch: Callable[["FigureInstance", Optional[str], Optional[str]], Patch]
+    describe: Callable[[go.Figure], dict]
+
+    @cached_property
+    def base(self) -> dict:
+        """Figure serialized into a dictionary, computed once"""
+        return self.figure.to_dict()
+
+    @cached_property
+    def json(self) -> bytes:
+        """Figure serialized to JSON, computed once (or read from a persisted snapshot)"""
+        return self.figure.to_json().encode()
+
+    @cached_property
+    def client_index(self) -> dict:
+        """
+        Compact description of the figure: country names in trace, bar or location order,
+        aliases of those names, and whatever else is needed to highlight in the browser
+        """
+        return self.describe(self.figure)
+
+    @cached_property
+    def positions(self) -> Dict[str, int]:
+        """Position of every country (and country alias) in the figure"""
+        positions = {name: position
+                     for position, name in enumerate(self.client_index["names"])}
+        for alias, name in self.client_index.get("aliases", {}).items():
+            if name in positions:
+                positions.setdefault(alias, positions[name])
+        return positions
+
+    def position(self, country: Optional[str]) -> Optional[int]:
+        """Trace, bar or location position of a country, None if it is not shown"""
+        return self.positions.get(country)
+
+    def name_at(self, position: int) -> str:
+        """Country name at a trace, bar or location position"""
+        return self.client_index["names"][position]
+
+    def render(self, country: Optional[str] = None) -> dict:
+        """
+        Serialized figure with the given country highlighted
+        :param country: country to highlight, None for the base figure
+        :return: figure dictionary
+        """
+        if country is None:
+            return self.base
+        return self.highlight(self, country)
+
+    def restyle(self, previous: Optional[str], country: Optional[str]) -> Patch:
+        """
+        Partial update moving the highlight of a rendered figure from one country to
+        another
+        :param previous: country highlighted on the client, if any
+        :param country: country to highlight, if any
+        :return: patch with the changed properties only
+        """
+        return self.patch(self, previous, country)
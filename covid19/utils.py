@@ -1,14 +1,19 @@
 """Helper utilities"""
 import json
+import os
 import re
-from copy import deepcopy
+import threading
 from datetime import datetime
+from functools import lru_cache
 from logging import getLogger
 from pathlib import Path
-from typing import Dict, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import yaml
 
+from covid19.profiling import profiler
+
 logger = getLogger(__name__)
 
 
@@ -28,11 +33,31 @@ def read_config() -> Dict[str, Dict[str, Union[str, int, float]]]:
     """
     app_dir = get_app_dir()
     config_path = app_dir / "config.yaml"
-    with open(str(config_path)) as stream:
+    with profiler.phase("config"), open(str(config_path)) as stream:
         config = yaml.safe_load(stream)
     return config
 
 
+def atomic_write(path: Path, content: Union[bytes, Iterable[bytes]]):
+    """
+    Write a file so that readers see either the old or the new content, never a
+    partial one
+    :param path: destination
+    :param content: bytes to write, or chunks of them (if reading the chunks fails,
+    the file is left as it was)
+    """
+    temporary_path = path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(str(temporary_path), "wb") as f:
+            for chunk in [content] if isinstance(content, bytes) else content:
+                f.write(chunk)
+    except BaseException:
+        temporary_path.unlink(missing_ok=True)
+        raise
+    os.replace(str(temporary_path), str(path))
+
+
 def to_date(date_str: str) -> datetime:
     """
     Format string dates to datetime
@@ -42,6 +67,117 @@ def to_date(date_str: str) -> datetime:
     return datetime.strptime(date_str, "%Y-%m-%d")
 
 
+def load_country_mappings() -> Dict[str, List[str]]:
+    """
+    Read the country name mappings
+    :return: names recognized by Plotly Choropleth with their aliases in the infection
+    data
+    """
+    app_dir = get_app_dir()
+    with open(str(app_dir / "resources" / "country_mappings.json")) as f:
+        country_mapping = f.read()
+    return json.loads(country_mapping)
+
+
+def load_populations() -> Dict[str, int]:
+    """
+    Read the population table
+    :return: population by country, under its Plotly Choropleth name where it has one
+    """
+    app_dir = get_app_dir()
+    with open(str(app_dir / "resources" / "population.json")) as f:
+        return json.load(f)
+
+
+class CountryTranslator:
+    """
+    Translates country names of the infection data into the names recognized by Plotly
+    Choropleth. The mapping is compiled once into an alias lookup and its inverse, and
+    batches of names and values are translated in a single pass
+    """
+
+    def __init__(self, mappings: Dict[str, List[str]]):
+        """
+        :param mappings: names recognized by Plotly Choropleth with their aliases
+        """
+        self.aliases = {country: list(aliases) for country, aliases in mappings.items()}
+        self.canonical = {alias: country
+                          for country, aliases in mappings.items() for alias in aliases}
+
+    def name(self, country: str) -> str:
+        """Name of a country as recognized by Plotly Choropleth"""
+        return self.canonical.get(country, country)
+
+    def original(self, country: str) -> str:
+        """
+        Name of a country in the infection data. Names that several countries of the data
+        are merged into (e.g. both Congos) are returned as they are
+        """
+        aliases = self.aliases.get(country, [])
+        return aliases[0] if len(aliases) == 1 else country
+
+    def translate(self,
+                  countries: List[str],
+                  values: np.ndarray,
+                  weights: Optional[np.ndarray] = None) -> Tuple[List[str], np.ndarray]:
+        """
+        Translate country names, summing up the values of countries that are merged
+        :param countries: country names in the infection data
+        :param values: a value per country
+        :param weights: a weight per country; when given, merged values are averaged with
+        these weights instead of summed (e.g. rates weighted by population)
+        :return: a tuple of translated names (in order of first appearance) and their
+        values
+        """
+        positions: Dict[str, int] = {}
+        groups = np.array([positions.setdefault(self.name(country), len(positions))
+                           for country in countries], dtype=int)
+        values = np.asarray(values)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            weighted, total_weights = np.zeros(len(positions)), np.zeros(len(positions))
+            np.add.at(weighted, groups, values * weights)
+            np.add.at(total_weights, groups, weights)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                return list(positions), weighted / total_weights
+        totals = np.zeros(len(positions), dtype=values.dtype)
+        np.add.at(totals, groups, values)
+        return list(positions), totals
+
+    def lookup(self, countries: List[str], table: Dict[str, float]) -> np.ndarray:
+        """
+        Values of a table keyed by country for the countries of the infection data; a
+        country is looked up under its own name, then under its Plotly Choropleth name
+        :param countries: country names in the infection data
+        :param table: value by country
+        :return: a value per country, NaN for countries missing from the table
+        """
+        return np.array([table.get(country, table.get(self.name(country), np.nan))
+                         for country in countries], dtype=float)
+
+
+@lru_cache(maxsize=None)
+def get_country_translator() -> CountryTranslator:
+    """Country translator of resources/country_mappings.json, loaded once"""
+    return CountryTranslator(load_country_mappings())
+
+
+@lru_cache(maxsize=None)
+def get_populations() -> Dict[str, int]:
+    """Population table of resources/population.json, loaded once"""
+    return load_populations()
+
+
+def population_index(countries: List[str]) -> np.ndarray:
+    """
+    Join the population table to a list of countries
+    :param countries: country names in the infection data
+    :return: population per country, NaN where it is unknown (e.g. regions and cruise
+    ships)
+    """
+    return get_country_translator().lookup(countries, get_populations())
+
+
 def translate_countries(countries: Dict[str, int]) -> Dict[str, int]:
     """
     Convert inconsistent country names into the format
@@ -49,21 +185,9 @@ def translate_countries(countries: Dict[str, int]) -> Dict[str, int]:
     :param countries: a dictionary with countries and counts
     :return: updated dictionary with countries and counts
     """
-    app_dir = get_app_dir()
-    with open(str(app_dir / "resources" / "country_mappings.json")) as f:
-        country_mapping = f.read()
-    country_mapping = json.loads(country_mapping)
-    modified_countries = deepcopy(countries)
-    for country, content in country_mapping.items():
-        modified = {country: sum([modified_countries[lookup]
-                                  for lookup in content
-                                  if lookup in modified_countries])}
-        if sum(modified.values()) > 0:
-            modified_countries.update(modified)
-        for lookup in content:
-            if lookup in modified_countries:
-                del modified_countries[lookup]
-    return modified_countries
+    names, totals = get_country_translator().translate(list(countries),
+                                                       list(countries.values()))
+    return dict(zip(names, totals.tolist()))
 
 
 def extract_css_variables() -> Dict[str, str]:
@@ -72,7 +196,7 @@ def extract_css_variables() -> Dict[str, str]:
     variable_pattern = r"\s+-{2}(\w?|-?)+:\s.*;$"
     app_dir = get_app_dir()
     css_path = app_dir / "assets" / "style.css"
-    with open(str(css_path)) as css:
+    with profiler.phase("css"), open(str(css_path)) as css:
         for line in css.readlines():
             if re.match(variable_pattern, line):
                 variable, value = re.sub(r"\s|--|;", "", line).split(":")
@@ -1,12 +1,35 @@
 """Tests for the project"""
+import builtins
+import gzip
+import json
+import mmap
+import threading
+import time
+from dataclasses import replace
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import numpy as np
 import pytest
+from dash import Patch
+from dash.exceptions import PreventUpdate
+from flask import Flask, request
 
-from covid19.data import get_infection_data, filter_infection_data
-from covid19.stats import get_cases
-from covid19.types import InfectionStatus
-from covid19.utils import read_config, to_date, translate_countries
+from covid19.data import filter_infection_data, fetch_payload, InfectionStore
+from covid19.ingest import parse_infections
+from covid19 import archive, benchmark, callbacks as cb, layout, metrics, refresh
+from covid19.metrics import Histogram
+from covid19.payloads import EncodedPayload, placeholder, splice_json
+from covid19.plots import FigureSet, Graphic, LazyFigureSets, plot_infected_countries
+from covid19.profiling import StartupProfiler
+from covid19.refresh import build_snapshot, Snapshot, SnapshotRefresher
+from covid19.snapshot import read_snapshot, shared_snapshot
+from covid19.sources import DataSource, fetch_sources, FileSource, HttpSource
+from covid19.stats import (build_summary_stats, fit_growth_models, fit_log_linear,
+                           get_cases)
+from covid19.types import Derivation, DerivedStatus, InfectionStatus, METRICS
+from covid19.utils import (CountryTranslator, population_index, read_config, to_date,
+                           translate_countries)
 
 
 def test_read_config():
@@ -14,14 +37,15 @@ def test_read_config():
     config_has_content = bool(config)
     config_is_dict = isinstance(config, dict)
     assert config_has_content and config_is_dict, "malformed config"
+    cache_size = config["figures"]["cache_size"]
+    assert cache_size >= len(METRICS), "switching metrics evicts figures"
 
 
-def test_get_infection_data():
-    infection_data = get_infection_data()
-    first_country = list(infection_data.keys())[0]
-    latest_entry_date = to_date(infection_data[first_country][-1]["date"])
-    max_date = max([to_date(entry["date"]) for entry in infection_data[first_country]])
-    assert max_date == latest_entry_date, "dates in infection data are not sorted"
+def test_build_snapshot_reads_the_configured_source(local_endpoint):
+    raw = build_snapshot().raw
+    expected = InfectionStore.from_infections(synthetic_infections())
+    assert raw.to_infections() == expected.to_infections()
+    assert (np.diff(raw.dates) > np.timedelta64(0, "D")).all(), "dates are not sorted"
 
 
 @pytest.mark.parametrize("infection_data, kind, min_cases, min_date, expected", [
@@ -62,3 +86,669 @@ def test_to_date(date_str, date):
 ])
 def test_translate_countries(raw, translated):
     assert translate_countries(raw) == translated, "country translation is broken"
+
+
+def test_country_translator_merges_and_maps_back():
+    translator = CountryTranslator({"DRC": ["Congo (Brazzaville)", "Congo (Kinshasa)"],
+                                    "Taiwan": ["Taiwan*"]})
+    names, values = translator.translate(
+        ["Congo (Kinshasa)", "Taiwan*", "Italy", "Congo (Brazzaville)"],
+        np.array([1, 2, 3, 4]))
+    assert names == ["DRC", "Taiwan", "Italy"] and values.tolist() == [5, 2, 3]
+    assert translator.original("Taiwan") == "Taiwan*"
+    assert translator.original("DRC") == "DRC" and translator.original("Italy") == "Italy"
+
+
+@pytest.mark.parametrize("infection_data, kind, min_cases, min_date", [
+    (
+            {"A": [{"date": "2020-1-1", "confirmed": 1, "deaths": 0},
+                   {"date": "2020-1-2", "confirmed": 5, "deaths": 1},
+                   {"date": "2020-1-3", "confirmed": 9, "deaths": 2}],
+             "B": [{"date": "2020-1-2", "confirmed": 0, "deaths": 0},
+                   {"date": "2020-1-3", "confirmed": 3, "deaths": 0}]},
+            InfectionStatus.CONFIRMED, 3, datetime(2020, 1, 2)
+    ),
+    (
+            {"A": [{"date": "2020-1-1", "confirmed": 4},
+                   {"date": "2020-1-2", "confirmed": 2},
+                   {"date": "2020-1-4", "confirmed": 6}],
+             "B": [{"date": "2020-1-1", "confirmed": 1},
+                   {"date": "2020-1-3", "confirmed": 3},
+                   {"date": "2020-1-4", "confirmed": 3}]},
+            InfectionStatus.CONFIRMED, 3, datetime(2020, 1, 1)
+    ),
+    (
+            {"A": [{"date": "2020-1-1", "confirmed": 4},
+                   {"date": "2020-1-2", "confirmed": 2}],
+             "B": [{"date": "2020-1-1", "confirmed": 1},
+                   {"date": "2020-1-3", "confirmed": 3}]},
+            InfectionStatus.CONFIRMED, 4, datetime(2020, 1, 2)
+    ),
+])
+def test_infection_store_filter(infection_data, kind, min_cases, min_date):
+    store = InfectionStore.from_infections(infection_data)
+    filtered = store.filter(kind, min_cases, min_date).to_infections()
+    assert filtered == filter_infection_data(
+        InfectionStore.from_infections(infection_data).to_infections(),
+        kind,
+        min_cases,
+        min_date,
+    )
+
+
+@pytest.mark.parametrize("lag, expected", [(1, [9, 3]), (2, [5, 0]), (3, [1, 0])])
+def test_infection_store_latest(lag, expected):
+    store = InfectionStore.from_infections({
+        "A": [{"date": "2020-1-1", "confirmed": 1}, {"date": "2020-1-2", "confirmed": 5},
+              {"date": "2020-1-3", "confirmed": 9}],
+        "B": [{"date": "2020-1-3", "confirmed": 3}]})
+    assert store.latest(InfectionStatus.CONFIRMED, lag).tolist() == expected
+
+
+def test_infection_store_aligned():
+    store = InfectionStore.from_infections({
+        "A": [{"date": "2020-1-1", "confirmed": 1}, {"date": "2020-1-2", "confirmed": 5}],
+        "B": [{"date": "2020-1-2", "confirmed": 3}]})
+    values, valid = store.aligned(InfectionStatus.CONFIRMED)
+    assert values[valid].tolist() == [1, 5, 3]
+    assert np.array_equal(valid, [[True, True], [True, False]])
+
+
+def test_ranking_index_slices_top_countries_of_any_date():
+    store = InfectionStore.from_infections({
+        "A": [{"date": "2020-1-1", "confirmed": 5}, {"date": "2020-1-3", "confirmed": 9}],
+        "B": [{"date": f"2020-1-{day}", "confirmed": 2 * day} for day in (1, 2, 3)],
+        "C": [{"date": "2020-1-2", "confirmed": 7}],
+        "D": []})
+    ranking = store.ranking(InfectionStatus.CONFIRMED)
+    assert store.ranking(InfectionStatus.CONFIRMED) is ranking, "ranking was rebuilt"
+    rows, values = ranking.top(10, column=0)
+    assert rows.tolist() == [0, 1] and values.tolist() == [5, 2]
+    rows, values = ranking.top(2, column=1)
+    assert rows.tolist() == [2, 0] and values.tolist() == [7, 5]
+    rows, values = ranking.top(10)
+    assert [store.countries[row] for row in rows] == ["A", "C", "B"]
+    bars = plot_infected_countries(store, top_n=2).data[0]
+    assert list(bars.x) == ["C", "A"] and list(bars.y) == [7, 9]
+
+
+def test_ranking_index_of_an_empty_store():
+    store = InfectionStore(countries=["A"], dates=np.empty(0, dtype="datetime64[D]"),
+                           counts={InfectionStatus.CONFIRMED: np.zeros((1, 0),
+                                                                       dtype=np.int64)},
+                           observed=np.zeros((1, 0), dtype=bool))
+    rows, values = store.ranking(InfectionStatus.CONFIRMED).top(20)
+    assert rows.size == values.size == 0
+    assert len(plot_infected_countries(store).data[0].x) == 0
+
+
+def test_fit_log_linear_matches_least_squares():
+    counts = np.array([[10, 100, 900, 0], [20, 300, 2000, 30000]])
+    valid = np.array([[True, True, True, False], [True, True, True, True]])
+    fit = fit_log_linear(counts, valid)
+    days = np.broadcast_to(np.arange(4), counts.shape)[valid]
+    slope, intercept = np.polyfit(days, np.log10(counts[valid]), 1)
+    assert fit.slope == pytest.approx(slope) and fit.intercept == pytest.approx(intercept)
+
+
+def test_fit_growth_models_per_country():
+    store = InfectionStore.from_infections({
+        "A": [{"date": f"2020-1-{day + 1}", "confirmed": 100 * 2 ** day}
+              for day in range(6)],
+        "B": [{"date": f"2020-1-{day + 3}", "confirmed": 100 + day * (day % 3)}
+              for day in range(5)],
+        "C": [{"date": "2020-1-1", "confirmed": 100},
+              {"date": "2020-1-2", "confirmed": 200}]})
+    growth = fit_growth_models(InfectionStatus.CONFIRMED, store, window=4)
+    days, counts = np.arange(1, 5), store.series("B", InfectionStatus.CONFIRMED)[1][-4:]
+    slope, intercept = np.polyfit(days, np.log10(counts), 1)
+    assert (growth.slope[1], growth.intercept[1]) == pytest.approx((slope, intercept))
+    assert growth.doubling_time[0] == pytest.approx(1)
+    assert growth.r_squared[0] == pytest.approx(1)
+    assert np.isnan(growth.slope[2]) and growth.describe("C") == "Growth: not enough data"
+    lower, upper = growth.interval(np.array([2.0]))
+    assert lower[1, 0] < growth.predict(np.array([2.0]))[1, 0] < upper[1, 0]
+
+
+def test_infection_store_derive():
+    raw = InfectionStore.from_infections({
+        "A": [{"date": f"2020-1-{day}", "confirmed": 10 * day} for day in (1, 2, 4, 5)],
+        "B": [{"date": f"2020-1-{day}", "confirmed": 5} for day in range(1, 6)]})
+    daily = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.DAILY)
+    average = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.AVERAGE)
+    change = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.WEEKLY_CHANGE)
+    per_100k = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.PER_100K)
+    assert set(raw.derive().counts) == {InfectionStatus.CONFIRMED, daily, average, change,
+                                        per_100k}
+    store = raw.derive(window=2, metrics=[daily, average, change])
+    assert set(store.counts) == {InfectionStatus.CONFIRMED, daily, average, change}
+    assert store.series("A", daily)[1].tolist() == [10, 10, 20, 10]
+    assert store.counts[average][0].tolist() == [5, 10, 5, 10, 15]
+    assert store.totals[daily].tolist() == [15, 10, 0, 20, 10]
+    assert store.counts[change][0, 4] == pytest.approx(2)
+    assert np.isnan(store.counts[change][1, 4])
+    filtered = store.filter(min_cases=30)
+    assert filtered.series("A", daily)[1].tolist() == [20, 10]
+    assert filtered.totals[daily].tolist() == [15, 10, 0, 20, 10]
+
+
+def test_derived_series_metrics_build_figures():
+    countries = ("Italy", "Congo (Brazzaville)", "Congo (Kinshasa)")
+    infection_data = synthetic_infections(countries)
+    italy = infection_data["Italy"]
+    italy[-2]["confirmed"] = italy[-1]["confirmed"] + 1000  # revised down the next day
+    raw = InfectionStore.from_infections(infection_data)
+    daily = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.DAILY)
+    assert raw.derive().counts[daily][0, -1] < 0
+    graphic = Graphic(raw.derive().filter())
+    for derivation in (Derivation.DAILY, Derivation.AVERAGE, Derivation.WEEKLY_CHANGE):
+        for kind in InfectionStatus:
+            metric = DerivedStatus(kind, derivation)
+            assert metric in METRICS
+            label = layout.metric_labels[metric.value]
+            figures = graphic.figures[metric.value]
+            assert [instance.figure.data for instance in figures.instances()]
+            assert figures.bars.figure.layout.yaxis.title.text == label
+            assert f"{label}: " in figures.map.figure.data[0].hovertemplate
+    change = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.WEEKLY_CHANGE)
+    world_map = graphic.figures[change.value].map.figure.data[0]
+    congo = float(world_map.hovertext[list(world_map.locations).index("DRC")])
+    changes = graphic.data.latest(change)[1:]
+    assert min(changes) <= congo <= max(changes), "weekly changes were summed"
+
+
+def test_population_normalized_metrics():
+    countries = ("Italy", "Congo (Brazzaville)", "Congo (Kinshasa)", "Diamond Princess")
+    raw = InfectionStore.from_infections(synthetic_infections(countries))
+    population = population_index(list(countries) + ["Czechia"])
+    czech_republic = population_index(["Czech Republic"])[0]
+    assert population[-1] == czech_republic, "alias was not resolved"
+    assert np.isnan(population[3])
+    derived = raw.derive()
+    per_100k = DerivedStatus(InfectionStatus.CONFIRMED, Derivation.PER_100K)
+    per_case = DerivedStatus(InfectionStatus.DEATHS, Derivation.PER_CASE)
+    confirmed = raw.counts[InfectionStatus.CONFIRMED]
+    deaths = raw.counts[InfectionStatus.DEATHS]
+    assert np.allclose(derived.counts[per_100k][:3],
+                       confirmed[:3] * 1e5 / population[:3, None])
+    assert np.isnan(derived.counts[per_100k][3]).all()
+    assert np.allclose(derived.counts[per_case], deaths / confirmed)
+
+    graphic = Graphic(derived.filter())
+    assert list(graphic.figures) == [metric.value for metric in METRICS]
+    figures = graphic.figures[per_100k.value]
+    assert [trace.name for trace in figures.curve.figure.data] == list(countries[:3])
+    world_map = figures.map.figure.data[0]
+    congo = world_map.hovertext[list(world_map.locations).index("DRC")]
+    expected = confirmed[1:3, -1].sum() * 1e5 / population[1:3].sum()
+    assert float(congo) == pytest.approx(expected, abs=1e-4)
+    assert "Cases per 100k: " in world_map.hovertemplate
+    assert figures.bars.figure.layout.yaxis.title.text == "Cases per 100k"
+    assert "Cases per 100k: " in figures.bars.figure.data[0].hovertemplate
+    assert "Cases per 100k: " in figures.map.render("Italy")["data"][-1]["hovertemplate"]
+
+
+def test_infection_store_diff():
+    old = {"A": [{"date": "2020-1-1", "confirmed": 1},
+                 {"date": "2020-1-2", "confirmed": 2}],
+           "B": [{"date": "2020-1-1", "confirmed": 4}],
+           "C": [{"date": "2020-1-1", "confirmed": 7}]}
+    new = {"A": [{"date": "2020-1-1", "confirmed": 1},
+                 {"date": "2020-1-2", "confirmed": 3}],
+           "B": [{"date": "2020-1-1", "confirmed": 4}],
+           "D": [{"date": "2020-1-3", "confirmed": 1}]}
+    delta = InfectionStore.from_infections(old).diff(InfectionStore.from_infections(new))
+    assert delta.countries == ["A", "D"] and delta.removed == ["C"]
+    latest = InfectionStore.from_infections(new)
+    assert latest.diff(InfectionStore.from_infections(new)).empty
+
+
+@pytest.mark.parametrize("chunk_size", [1, 64, 1 << 20])
+def test_parse_infections_matches_from_infections(chunk_size):
+    infection_data = {**synthetic_infections(),
+                      "Korea, \"South\" [x]": [{"date": "2020-3-1", "confirmed": None},
+                                               {"date": "2020-3-2", "confirmed": 2.0}],
+                      "Records of another shape": [{"confirmed": 3, "date": "2020-03-05"},
+                                                   {"date": "2020-3-6", "deaths": 1}],
+                      "Empty": []}
+    body = json.dumps(infection_data, indent=1).encode()
+    parsed = parse_infections(body[start:start + chunk_size]
+                              for start in range(0, len(body), chunk_size))
+    expected = InfectionStore.from_infections(infection_data)
+    assert parsed.countries == expected.countries
+    assert parsed.to_infections() == expected.to_infections()
+    assert (parsed.observed == expected.observed).all()
+    with pytest.raises(ValueError):
+        parse_infections([body[:len(body) // 2]])
+
+
+@pytest.mark.parametrize("body, message", [
+    (b"<html>Service Unavailable</html>", "not a JSON object"),
+    (b"", "not a JSON object"),
+    (b'{"error": "rate limit exceeded"}', "unexpected content"),
+    (b"{}", "no countries"),
+    (b'{"A": [{"date": "2020-1-1", "confirmed": 1}],', "truncated"),
+    (b'{"A": [{"date": "2020-1-1", "confirmed": 1}], "B"', "truncated"),
+    (b'{"A": [{"date": "2020-1-1", "confirmed": 1}]', "truncated")])
+def test_parse_infections_rejects_incomplete_payloads(body, message):
+    with pytest.raises(ValueError, match=message):
+        parse_infections(body[start:start + 8] for start in range(0, len(body), 8))
+
+
+def test_snapshot_refresher_swaps_and_survives_failures():
+    builds = iter([1, 2, ValueError("feed down"), 3])
+
+    def build(previous):
+        result = next(builds)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    refresher = SnapshotRefresher(build, interval=60)
+    assert refresher.snapshot == 1
+    assert refresher.refresh() and refresher.snapshot == 2
+    assert (
+        not refresher.refresh() and refresher.snapshot == 2
+    ), "failed refresh replaced snapshot"
+    assert refresher.refresh() and refresher.snapshot == 3
+
+
+@pytest.fixture
+def payload_server():
+    """Serve a fixed JSON body with an ETag, honouring If-None-Match"""
+
+    class Handler(BaseHTTPRequestHandler):
+        body = b'{"Country": []}'
+        etag = '"v1"'
+        statuses = []
+        delays = {}
+
+        def do_GET(self):
+            time.sleep(self.delays.get(self.path, 0))
+            if self.headers.get("If-None-Match") == self.etag:
+                self.statuses.append(304)
+                self.send_response(304)
+                self.end_headers()
+            else:
+                self.statuses.append(200)
+                self.send_response(200)
+                self.send_header("ETag", self.etag)
+                self.send_header("Content-Length", str(len(self.body)))
+                self.end_headers()
+                self.wfile.write(self.body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/timeseries.json", Handler, server
+    server.shutdown()
+
+
+def test_fetch_payload_conditional_and_offline(payload_server, tmp_path):
+    url, handler, server = payload_server
+    first = fetch_payload(url, tmp_path, timeout=5)
+    assert first.modified and first.body == handler.body
+    second = fetch_payload(url, tmp_path, timeout=5)
+    assert not second.modified and second.body == handler.body
+    assert handler.statuses == [200, 304], "validators were not sent"
+    server.shutdown()
+    server.server_close()
+    offline = fetch_payload(url, tmp_path, timeout=1)
+    assert not offline.modified and offline.body == handler.body
+
+
+def test_fetch_sources_concurrently_and_combine(payload_server, tmp_path):
+    url, handler, server = payload_server
+    handler.delays = {"/slow.json": 2}
+    regions = tmp_path / "regions.csv"
+    regions.write_text("country,region,date,confirmed,deaths\n"
+                       "Italy,Lombardy,2020-03-01,5,\n"
+                       "Italy,Lombardy,2020-03-02,8,1\n")
+    slow = HttpSource("slow", url.replace("timeseries", "slow"), timeout=0.2,
+                      required=False)
+    sources = [HttpSource("national", url), slow,
+               FileSource("regions", str(regions), "csv")]
+    start = time.perf_counter()
+    payloads = fetch_sources(sources, tmp_path / "cache")
+    assert time.perf_counter() - start < 1, "the slow source held up the refresh"
+    assert list(payloads) == ["national", "regions"]
+    assert payloads["regions"].modified
+    assert not fetch_sources(sources[2:], tmp_path / "cache")["regions"].modified
+    with pytest.raises(TimeoutError):
+        fetch_sources([replace(slow, required=True)], tmp_path / "cache")
+    with pytest.raises(TypeError):
+        DataSource("abstract", url)
+
+    raw = InfectionStore.combine([source.parse(payloads[source.name].chunks())
+                                  for source in sources if source.name in payloads])
+    assert raw.countries == ["Country", "Italy / Lombardy"]
+    assert raw.series("Italy / Lombardy", InfectionStatus.CONFIRMED)[1].tolist() == [5, 8]
+    assert raw.series("Italy / Lombardy", InfectionStatus.DEATHS)[1].tolist() == [0, 1]
+    revised = InfectionStore.from_infections({"Italy / Lombardy": [{"date": "2020-3-2",
+                                                                    "confirmed": 9}]})
+    combined = InfectionStore.combine([raw, revised])
+    _, counts = combined.series("Italy / Lombardy", InfectionStatus.CONFIRMED)
+    assert counts.tolist() == [9]
+
+
+def synthetic_infections(countries=("Italy", "Spain", "China"), days=40):
+    """Small exponential outbreaks in the timeseries.json format"""
+    return {country: [{"date": (f"2020-3-{day % 28 + 1}" if day < 28
+                                else f"2020-4-{day - 27}"),
+                       "confirmed": 50 * 2 ** (day // (position + 3)),
+                       "deaths": 2 ** (day // (position + 3))}
+                      for day in range(days)]
+            for position, country in enumerate(countries)}
+
+
+@pytest.fixture
+def local_endpoint(payload_server, tmp_path, monkeypatch):
+    """Serve synthetic infections as the configured endpoint, cached in a temporary dir"""
+    url, handler, server = payload_server
+    handler.body = json.dumps(synthetic_infections()).encode()
+    config = read_config()
+    config["sources"] = [{"name": "national", "url": url}]
+    config["fetch"]["cache_dir"] = str(tmp_path)
+    monkeypatch.setattr("covid19.refresh.read_config", lambda: config)
+    yield handler
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_archive_round_trip(tmp_path, compress):
+    raw = InfectionStore.from_infections(synthetic_infections())
+    path = archive.write_archive(raw, tmp_path / "infections.c19", compress,
+                                 source={"v": 1})
+    loaded = archive.read_archive(path)
+    assert archive.read_header(path)["source"] == {"v": 1}
+    assert loaded.to_infections() == raw.to_infections()
+    assert loaded.counts[InfectionStatus.CONFIRMED].dtype == np.int32
+    assert not loaded.observed.flags.writeable
+    assert isinstance(loaded.observed.base, mmap.mmap) != compress, "columns were copied"
+    assert (loaded.derive().filter().to_infections()
+            == raw.derive().filter().to_infections())
+    path.write_bytes(path.read_bytes().replace(archive.MAGIC + b"\x01",
+                                               archive.MAGIC + b"\x02"))
+    with pytest.raises(ValueError, match="version"):
+        archive.read_archive(path)
+
+
+def test_archive_cli_builds_from_json(tmp_path):
+    source = tmp_path / "timeseries.json"
+    source.write_text(json.dumps(synthetic_infections()))
+    archive.main([str(source), str(tmp_path / "infections.c19"), "--compress"])
+    loaded = archive.read_archive(tmp_path / "infections.c19")
+    assert loaded.to_infections() == InfectionStore.from_infections(
+        synthetic_infections()).to_infections()
+
+
+def test_build_snapshot_starts_from_archive(local_endpoint, tmp_path):
+    first = build_snapshot()
+    assert list(tmp_path.glob("*.c19")), "archive was not written"
+    second = build_snapshot()
+    assert local_endpoint.statuses == [200, 304]
+    assert isinstance(second.raw.observed.base, mmap.mmap), "payload was parsed again"
+    assert second.raw.to_infections() == first.raw.to_infections()
+    assert second.summary == first.summary
+
+
+def test_build_snapshot_catches_up_with_a_body_fetched_elsewhere(local_endpoint,
+                                                                 tmp_path):
+    first = build_snapshot()
+    local_endpoint.body = json.dumps(synthetic_infections(days=45)).encode()
+    local_endpoint.etag = '"v2"'
+    fetch_payload(refresh.read_config()["sources"][0]["url"], tmp_path, timeout=5)
+    second = build_snapshot(first)
+    assert local_endpoint.statuses == [200, 200, 304]
+    assert second is not first, "a snapshot of the old body was kept after a 304"
+    assert len(second.raw.dates) == 45
+    assert build_snapshot(second) is second
+
+
+def build_test_snapshot(previous=None):
+    raw = InfectionStore.from_infections(synthetic_infections())
+    data = raw.derive().filter()
+    graphic = Graphic(data)
+    graphic.figures[InfectionStatus.CONFIRMED.value]
+    return Snapshot(raw=raw, data=data, summary=build_summary_stats(data),
+                    graphic=graphic,
+                    growth=graphic.growth, created=datetime.utcnow())
+
+
+def test_shared_snapshot_round_trip(tmp_path):
+    builds = []
+
+    def build(previous):
+        builds.append(previous)
+        return build_test_snapshot()
+
+    first = shared_snapshot(tmp_path, max_age=3600, build=build)(None)
+    second = shared_snapshot(tmp_path, max_age=3600, build=build)(None)
+    assert len(builds) == 1, "a fresh shared snapshot was rebuilt"
+    assert isinstance(second.raw.observed.base, mmap.mmap)
+    assert isinstance(second.data.observed, np.memmap)
+    assert second.raw.to_infections() == first.raw.to_infections()
+    assert second.data.to_infections() == build_test_snapshot().data.to_infections()
+    assert ([stat.value_str for stat in vars(second.summary).values()]
+            == [stat.value_str for stat in vars(first.summary).values()])
+    assert second.growth.keys() == first.growth.keys()
+    for metric, models in second.growth.items():
+        assert isinstance(models.slope, np.memmap), "growth models were fitted again"
+        assert models.countries == first.growth[metric].countries
+        assert models.window == first.growth[metric].window
+        np.testing.assert_array_equal(models.slope, first.growth[metric].slope)
+        np.testing.assert_array_equal(models.day_spread, first.growth[metric].day_spread)
+    assert first.version == second.version == read_snapshot(tmp_path).version
+    assert list(second.graphic.figures.built()) == [InfectionStatus.CONFIRMED.value]
+    assert second.data.counts.keys() == first.data.counts.keys()
+    assert second.data.totals.keys() == first.data.totals.keys()
+    for metric, figure_set in second.graphic.figures.items():
+        for built, loaded in zip(first.graphic.figures[metric].instances(),
+                                 figure_set.instances()):
+            assert built.id_str == loaded.id_str
+            assert ([trace.name for trace in built.figure.data]
+                    == [trace.name for trace in loaded.figure.data])
+            assert loaded.json == built.json
+
+
+def test_graphic_builds_figure_sets_lazily():
+    data = InfectionStore.from_infections(synthetic_infections()).filter()
+    graphic = Graphic(data)
+    assert graphic.figures.built() == {}
+    deaths = graphic.figures[InfectionStatus.DEATHS.value]
+    assert graphic.figures[InfectionStatus.DEATHS.value] is deaths
+    assert list(graphic.figures.built()) == [InfectionStatus.DEATHS.value]
+    with pytest.raises(KeyError):
+        graphic.figures["recovered"]
+    figures = LazyFigureSets(lambda kind: FigureSet(data, kind), graphic.figures.metrics,
+                             maxsize=1, built={InfectionStatus.DEATHS.value: deaths})
+    figures[InfectionStatus.CONFIRMED.value]
+    assert list(figures.built()) == [InfectionStatus.CONFIRMED.value]
+    assert figures[InfectionStatus.DEATHS.value] is not deaths
+
+
+def test_lazy_figure_sets_serve_built_metrics_while_building_another():
+    building, release, builds = threading.Event(), threading.Event(), []
+
+    def build(kind):
+        builds.append(kind)
+        if kind == InfectionStatus.DEATHS:
+            building.set()
+            release.wait(5)
+        return kind.value
+
+    figures = LazyFigureSets(build, ["confirmed", "deaths"], maxsize=2)
+    figures["confirmed"]
+    requests = [threading.Thread(target=lambda: figures["deaths"]) for _ in range(2)]
+    for thread in requests:
+        thread.start()
+    assert building.wait(5)
+    start = time.perf_counter()
+    assert figures["confirmed"] == "confirmed"
+    assert time.perf_counter() - start < 1, "a cold metric held up a built one"
+    release.set()
+    for thread in requests:
+        thread.join()
+    assert builds == [InfectionStatus.CONFIRMED, InfectionStatus.DEATHS]
+
+
+def test_highlight_overlay_leaves_shared_figures_untouched():
+    figure_set = build_test_snapshot().graphic.figures[InfectionStatus.CONFIRMED.value]
+    for instance in figure_set.instances():
+        before = repr(instance.base)
+        highlighted = instance.render("Spain")
+        assert highlighted is not instance.base, f"{instance.id_str} was not highlighted"
+        assert repr(instance.base) == before, f"{instance.id_str} base was mutated"
+        assert repr(instance.figure.to_dict()) == before
+    curve = figure_set.curve.render("Spain")
+    spain = [trace for trace in curve["data"] if trace["name"] == "Spain"][0]
+    assert spain["line"]["width"] == layout.styles.highlight.line_width
+    assert figure_set.curve.render(None) is figure_set.curve.base
+
+
+def test_restyle_patches_only_changed_traces():
+    figure_set = build_test_snapshot().graphic.figures[InfectionStatus.CONFIRMED.value]
+    operations = figure_set.curve.restyle("Italy", "Spain").to_plotly_json()["operations"]
+    positions = {trace.name: index
+                 for index, trace in enumerate(figure_set.curve.figure.data)}
+    changed = {op["location"][1] for op in operations}
+    assert changed == {positions["Italy"], positions["Spain"]}
+    map_operations = figure_set.map.restyle(None, "Spain").to_plotly_json()["operations"]
+    assert [op["operation"] for op in map_operations] == ["Append"]
+
+
+def test_client_highlight_index_matches_figures():
+    figure_set = build_test_snapshot().graphic.figures[InfectionStatus.DEATHS.value]
+    index = cb.client_highlight_index(figure_set.instances(), token="deaths")
+    curve = index["figures"]["infection_curve"]
+    assert curve["names"] == [trace.name for trace in figure_set.curve.figure.data]
+    world = index["figures"]["infection_map"]
+    position = world["names"].index("Spain")
+    assert cb.map_overlay(figure_set.map, "Spain") == {
+        **world["overlay"], "locations": ["Spain"],
+        "z": [world["z"][position]], "hovertext": [world["hovertext"][position]]}
+
+
+def test_highlight_index_resolves_aliases():
+    infections = synthetic_infections(("Italy", "Taiwan*", "China"))
+    data = InfectionStore.from_infections(infections)
+    figure_set = FigureSet(data.filter(), InfectionStatus.CONFIRMED)
+    world = figure_set.map
+    assert world.position("Taiwan*") == world.position("Taiwan") is not None
+    assert cb.map_overlay(world, "Taiwan*")["locations"] == ["Taiwan"]
+    assert world.position("Atlantis") is None
+    assert figure_set.curve.name_at(figure_set.curve.position("Taiwan*")) == "Taiwan*"
+    hover = {"points": [{"location": "Taiwan"}]}
+    assert cb.find_selected_country([(world, hover)]) == "Taiwan*"
+
+
+def test_merged_lines_highlight_a_single_country():
+    data = InfectionStore.from_infections(synthetic_infections()).derive().filter()
+    figure_set = FigureSet(data, InfectionStatus.CONFIRMED, merged=True)
+    curve, trend = figure_set.curve, figure_set.trend
+    assert [trace.type for trace in curve.figure.data] == ["scattergl"]
+    assert curve.client_index["names"] == ["Italy", "Spain", "China"]
+    _, counts = data.series("Spain", InfectionStatus.CONFIRMED)
+    overlay = curve.render("Spain")["data"][-1]
+    assert overlay["name"] == "Spain" and list(overlay["y"]) == counts.tolist()
+    operations = curve.restyle("Italy", "Spain").to_plotly_json()["operations"]
+    assert [op["operation"] for op in operations] == ["Delete", "Append"]
+    assert operations[0]["location"] == ["data", 1]
+    position = trend.position("Spain")
+    details = trend.client_index["details"][position]
+    assert trend.render("Spain")["data"][-1]["meta"] == details
+    hover = {"points": [{"customdata": "Spain"}]}
+    assert cb.find_selected_country([(trend, hover)]) == "Spain"
+    assert cb.find_selected_country([(trend, {"points": [{"curveNumber": 1}]})]) is None
+
+
+def test_startup_profiler_records_nested_phases(tmp_path):
+    report_path = tmp_path / "profile.json"
+    profiler = StartupProfiler(enabled=True, report_path=report_path)
+    try:
+        with profiler.phase("snapshot"):
+            for _ in range(2):
+                with profiler.phase("fetch"):
+                    pass
+    finally:
+        report = profiler.finish()
+    assert builtins.__import__ is profiler._import
+    phases = [(phase["name"], phase["calls"]) for phase in report["phases"]]
+    assert phases == [("snapshot", 1), ("snapshot/fetch", 2)]
+    assert json.loads(report_path.read_text())["phases"] == report["phases"]
+    with profiler.phase("late"):
+        pass
+    assert "late" not in profiler.phases
+
+
+def test_histogram_renders_prometheus_buckets():
+    histogram = Histogram("latency_seconds", "Latency", buckets=(0.1, 1),
+                          labels=("figure",))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value, figure="map")
+    lines = histogram.render()
+    assert 'latency_seconds_bucket{figure="map",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{figure="map",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{figure="map"} 3.65' in lines
+    assert 'latency_seconds_count{figure="map"} 4' in lines
+
+
+def test_highlight_functions_are_instrumented():
+    figure_set = build_test_snapshot().graphic.figures[InfectionStatus.CONFIRMED.value]
+    figure_set.bars.restyle(None, "Spain")
+    lines = metrics.registry.render().splitlines()
+    assert any(line.startswith('covid19_highlight_function_seconds_count'
+                               '{function="patch_bars",figure="infected_countries"}')
+               for line in lines)
+
+
+def test_plot_actions_patches_hovers_and_renders_switches():
+    snapshot = build_test_snapshot()
+    instances = snapshot.graphic.figures[InfectionStatus.CONFIRMED.value].instances()
+    state = {"metric": "confirmed", "country": None, "snapshot": "v1"}
+    bars = [None, None, {"points": [{"x": "Spain"}]}, None]
+    outputs = cb.plot_actions(instances, bars, "confirmed", "v1", state)
+    assert outputs[-1] == {**state, "country": "Spain"}
+    assert all(isinstance(output, Patch) for output in outputs[:-1])
+    with pytest.raises(PreventUpdate):
+        cb.plot_actions(instances, bars, "confirmed", "v1", outputs[-1])
+    outputs = cb.plot_actions(instances, bars, "confirmed", "v2", outputs[-1])
+    assert outputs[0] == instances[0].render("Spain")
+
+
+def test_benchmark_runs_on_synthetic_data():
+    scale = benchmark.Scale(countries=8, days=60, regions=1)
+    infection_data = benchmark.synthetic_infections(scale)
+    assert len(infection_data) == 16 and "Italy / Region 00" in infection_data
+    assert infection_data == benchmark.synthetic_infections(scale)
+    results = dict(benchmark.run_scale(scale, repeat=1, hovers=8))
+    expected = {"ingest/parse", "plots/plot_infection_map", "callback/hover"}
+    assert expected <= results.keys()
+    assert results["callback/hover"]["throughput"] > 0
+
+
+def test_benchmark_hovers_merged_lines():
+    scale = benchmark.Scale(countries=8, days=60)
+    results = dict(benchmark.run_scale(scale, repeat=1, hovers=8, merged=True))
+    assert results["callback/hover"]["repeat"] > 0
+
+
+def test_encoded_payload_negotiates_coding_and_etag():
+    body = splice_json(json.dumps({"figure": placeholder("map"), "id": "map"}),
+                       {"map": b'{"data":[]}'})
+    assert json.loads(body) == {"figure": {"data": []}, "id": "map"}
+    payload = EncodedPayload.encode(body, ["br", "gzip", "zstd"])
+    assert {"identity", "gzip"} <= payload.bodies.keys() and "zstd" not in payload.bodies
+    with Flask(__name__).test_request_context(headers={"Accept-Encoding": "gzip"}):
+        response = payload.response(request)
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == body
+    etag = response.headers["ETag"]
+    with Flask(__name__).test_request_context(headers={"If-None-Match": etag,
+                                                       "Accept-Encoding": "gzip"}):
+        assert payload.response(request).status_code == 304
+    with Flask(__name__).test_request_context(headers={"If-None-Match": etag}):
+        response = payload.response(request)
+    assert response.status_code == 200 and response.get_data() == body